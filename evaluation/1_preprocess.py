@@ -5,44 +5,58 @@ MIT license
 '''
 
 import json
-import scipy
+import textwrap
 import argparse
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
+from model_inference.template_utils import iter_sample_chunks
+from model_inference.table_utils import ColumnarWriter, iter_table, read_table
+
+TEMPLATE_CHUNK_SIZE = 10000
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--samples-tsv-path", type=str, required=True)
-    parser.add_argument("--evaluation-tsv-path", type=str, default=None)
-    parser.add_argument("--evaluation-json-path", type=str, default=None)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--samples-tsv-path", type=str, help="samples tsv or columnar (.kbq) file")
+    source.add_argument("--templates-tsv-path", type=str,
+                        help="expand the templates into samples on the fly instead of reading a samples tsv; "
+                             "a superset of KoBBQ_all_samples.tsv, not for reported scores")
+    parser.add_argument("--evaluation-tsv-path", type=str, default=None,
+                        help="may contain {prompt_id} to write several prompts at once")
+    parser.add_argument("--evaluation-json-path", type=str, default=None,
+                        help="may contain {prompt_id} to write several prompts at once")
+    parser.add_argument("--evaluation-data-path", type=str, default=None,
+                        help="columnar (.kbq) file with the queries, for both model inference and post-processing; "
+                             "may contain {prompt_id}")
     parser.add_argument("--prompt-tsv-path", type=str, required=True)
-    parser.add_argument("--prompt-id", type=int, required=True)
+    parser.add_argument("--prompt-id", type=int, nargs='+', required=True)
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="number of samples processed at a time; all at once for a samples tsv by default")
+    parser.add_argument("--num-shards", type=int, default=1, help="with --templates-tsv-path")
+    parser.add_argument("--shard-index", type=int, default=0, help="with --templates-tsv-path")
+    parser.add_argument("--sample-rate", type=float, default=None,
+                        help="with --templates-tsv-path, keep this fraction of the samples")
+    parser.add_argument("--seed", type=int, default=0, help="with --sample-rate")
     args = parser.parse_args()
     return args
 
 
-def change_unk(x, unk):
-    if x == '알 수 없음':
-        return unk
-    else:
-        return x
-        
-
-def change_unk_choice(x, unk):
-    return [change_unk(choice, unk) for choice in x]
+# row i of scipy.linalg.circulant(choices)
+CIRCULANT_INDEX = (np.arange(3)[:, None] - np.arange(3)[None, :]) % 3
 
 
 def permute(df):
-    processed_df = pd.DataFrame(np.repeat(df.values, 3, axis=0), columns=df.columns)
-    permute_choices = pd.DataFrame(
-        np.concatenate(df['choices'].apply(lambda x: scipy.linalg.circulant(x))),
-        columns=['A', 'B', 'C']
-    )
-    processed_df = pd.concat([processed_df, permute_choices], axis=1)
-    processed_df['sample_id'] = processed_df['sample_id'] + ['-0', '-1', '-2'] * len(df)
-    processed_df['choices'] = processed_df.apply(lambda x: [x.A, x.B, x.C], axis=1)
+    choices = np.array(df['choices'].tolist(), dtype=object)
+    
+    processed_df = df.loc[df.index.repeat(3)].reset_index(drop=True)
+    processed_df[['A', 'B', 'C']] = choices[:, CIRCULANT_INDEX].reshape(-1, 3)
+    processed_df['sample_id'] = processed_df['sample_id'] + np.tile(['-0', '-1', '-2'], len(df))
+    processed_df['choices'] = processed_df[['A', 'B', 'C']].values.tolist()
+    
+    processed_df = processed_df.sort_values(by=['sample_id'])
     return processed_df
 
 
@@ -51,69 +65,138 @@ def make_prefix(df_prompts, prompt_id):
     return prefix + '\n\n'
         
 
-def make_prompt(df_prompts, prompt_id, context, question, A, B, C):
-    prompt_row = df_prompts[df_prompts['prompt_id'] == prompt_id]
-    
-    prompt = prompt_row['context'].item() + context + '\n'
-    prompt += prompt_row['question'].item() + question + '\n'
-    prompt += prompt_row['a'].item() + A + '\n'
-    prompt += prompt_row['b'].item() + B + '\n'
-    prompt += prompt_row['c'].item() + C + '\n'
+def make_prompt(prompt_row, context, question, A, B, C):
+    prompt = prompt_row['context'] + context + '\n'
+    prompt += prompt_row['question'] + question + '\n'
+    prompt += prompt_row['a'] + A + '\n'
+    prompt += prompt_row['b'] + B + '\n'
+    prompt += prompt_row['c'] + C + '\n'
     prompt += prompt_row['answer']
     
     return prompt
 
 
-def process(df, df_prompts, prompt_id):
-    unk = df_prompts[df_prompts['prompt_id'] == prompt_id]['unknown'].item()
+def apply_prompt(df, df_prompts, prompt_id):
+    prompt_row = df_prompts[df_prompts['prompt_id'] == prompt_id].iloc[0]
+    unk = prompt_row['unknown']
     
-    df['choices'] = df['choices'].apply(lambda x: change_unk_choice(x, unk))
-    df['answer'] = df['answer'].apply(lambda x: change_unk(x, unk))
-
-    df = permute(df)
-    df['answer_abc'] = df[['answer', 'A', 'B', 'C']].apply(lambda x: x[x == x.answer].index.tolist()[-1], axis=1)
+    df = df.copy()
+    df[['A', 'B', 'C']] = df[['A', 'B', 'C']].replace('알 수 없음', unk)
+    df['answer'] = df['answer'].replace('알 수 없음', unk)
+    df['choices'] = df[['A', 'B', 'C']].values.tolist()
+
+    df['answer_abc'] = np.select(
+        [df['C'] == df['answer'], df['B'] == df['answer'], df['A'] == df['answer']],
+        ['C', 'B', 'A'],
+        default='answer'
+    )
         
     prefix = make_prefix(df_prompts, prompt_id)
-    df['query'] = df.apply(lambda x: make_prompt(df_prompts, prompt_id, x.context, x.question, x.A, x.B, x.C), axis=1)
+    df['query'] = make_prompt(prompt_row, df['context'], df['question'], df['A'], df['B'], df['C'])
 
-    df = df.sort_values(by=['sample_id'])
     return df, prefix
 
 
-def to_tsv(df, tsv_path):
-    Path(tsv_path).parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(tsv_path, sep='\t', index=False)
-    
+def process(df, df_prompts, prompt_id):
+    return apply_prompt(permute(df), df_prompts, prompt_id)
 
-def to_json(df, prefix, json_path):
-    data = {
-        "ver": "test",
-        "prefix": prefix,
-        "data": df[['query', 'A', 'B', 'C', 'answer_abc', 'sample_id']].values.tolist()
-    }
-    
-    Path(json_path).parent.mkdir(parents=True, exist_ok=True)
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+
+def process_all(df, df_prompts, prompt_ids):
+    # the permutation does not depend on the prompt, so it is shared across prompts
+    df = permute(df)
+    for prompt_id in prompt_ids:
+        yield (prompt_id, *apply_prompt(df, df_prompts, prompt_id))
+
+
+def format_path(path, prompt_id, n_prompts):
+    if path is None:
+        return None
+    if '{prompt_id}' not in path:
+        if n_prompts > 1:
+            raise ValueError(f'{path} should contain {{prompt_id}} to write several prompts')
+        return path
+    return path.replace('{prompt_id}', str(prompt_id))
+
+
+class TsvWriter:
+    def __init__(self, tsv_path):
+        Path(tsv_path).parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(tsv_path, "w", encoding="utf-8", newline='')
+        self.header = True
+
+    def write(self, df):
+        df.to_csv(self.f, sep='\t', index=False, header=self.header)
+        self.header = False
+
+    def close(self):
+        self.f.close()
+
+
+class JsonWriter:
+    # same layout as json.dump(data, f, ensure_ascii=False, indent=4), written chunk by chunk
+    def __init__(self, json_path, prefix):
+        Path(json_path).parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(json_path, "w", encoding="utf-8")
+        self.f.write('{\n    "ver": "test",\n    "prefix": ' + json.dumps(prefix, ensure_ascii=False) + ',\n    "data": [')
+        self.empty = True
+
+    def write(self, df):
+        for row in df[['query', 'A', 'B', 'C', 'answer_abc', 'sample_id']].values.tolist():
+            self.f.write(('\n' if self.empty else ',\n') + textwrap.indent(json.dumps(row, ensure_ascii=False, indent=4), ' ' * 8))
+            self.empty = False
+
+    def close(self):
+        self.f.write(']\n}' if self.empty else '\n    ]\n}')
+        self.f.close()
+
+
+def read_samples(args):
+    if args.templates_tsv_path:
+        yield from iter_sample_chunks(
+            args.templates_tsv_path,
+            args.chunk_size or TEMPLATE_CHUNK_SIZE,
+            num_shards=args.num_shards,
+            shard_index=args.shard_index,
+            sample_rate=args.sample_rate,
+            seed=args.seed
+        )
+        return
+
+    # a samples tsv or a columnar file
+    if args.chunk_size is None:
+        yield read_table(args.samples_tsv_path)
+    else:
+        yield from iter_table(args.samples_tsv_path, args.chunk_size)
 
 
 def main(args):
-    df = pd.read_csv(args.samples_tsv_path, sep='\t')
-    df['choices'] = df['choices'].map(eval)
-    
     df_prompts = pd.read_csv(args.prompt_tsv_path, sep='\t')
-    
-    df, prefix = process(df, df_prompts, args.prompt_id)
-    
-    if args.evaluation_json_path:
-        to_json(
-            df,
-            prefix,
-            args.evaluation_json_path
-        )
-    if args.evaluation_tsv_path:
-        df = df.drop('query', axis=1)
-        to_tsv(df, args.evaluation_tsv_path)
+
+    # samples are processed chunk by chunk and appended to the outputs of every prompt
+    writers = {}
+    for df in read_samples(args):
+        for prompt_id, df_prompt, prefix in process_all(df, df_prompts, args.prompt_id):
+            if prompt_id not in writers:
+                evaluation_json_path = format_path(args.evaluation_json_path, prompt_id, len(args.prompt_id))
+                evaluation_tsv_path = format_path(args.evaluation_tsv_path, prompt_id, len(args.prompt_id))
+                evaluation_data_path = format_path(args.evaluation_data_path, prompt_id, len(args.prompt_id))
+                writers[prompt_id] = [
+                    JsonWriter(evaluation_json_path, prefix) if evaluation_json_path else None,
+                    TsvWriter(evaluation_tsv_path) if evaluation_tsv_path else None,
+                    ColumnarWriter(evaluation_data_path, {"ver": "test", "prefix": prefix}) if evaluation_data_path else None
+                ]
+            json_writer, tsv_writer, data_writer = writers[prompt_id]
+
+            if json_writer:
+                json_writer.write(df_prompt)
+            if tsv_writer:
+                tsv_writer.write(df_prompt.drop('query', axis=1))
+            if data_writer:
+                data_writer.write(df_prompt)
+
+    for writer in sum(writers.values(), []):
+        if writer:
+            writer.close()
 
     
 if __name__ == '__main__':
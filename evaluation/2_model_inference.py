@@ -6,9 +6,9 @@ MIT license
 
 import os
 import re
+import sys
 import csv
 import json
-import torch
 import argparse
 import numpy as np
 import pandas as pd
@@ -16,31 +16,226 @@ import pandas as pd
 from pathlib import Path
 from tqdm.auto import tqdm
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from model_inference.openai_utils import GPT_MODEL, get_gpt_response
-from model_inference.claude_utils import CLAUDE_MODEL, get_claude_response
-from model_inference.hyperclova_utils import HYPERCLOVA_MODEL, get_hyperclova_response
-from model_inference.koalpaca_utils import KOALPACA_MODEL, load_koalpaca, get_koalpaca_response
+# the backend modules (openai, anthropic, torch, ...) are imported only for the model that is run
+from model_inference.backend_utils import GPT_MODEL, CLAUDE_MODEL, KOALPACA_MODEL, SCORING_MODES, get_backend, load_backend, generate
+from model_inference.rate_limit_utils import describe_rate_limit, set_rate_limit
+from model_inference.session_utils import set_pool_size, set_timeout
+from model_inference.cache_utils import ResponseCache
+from model_inference.checkpoint_utils import PredictionWriter, merge_predictions
+from model_inference.table_utils import COLUMNAR_SUFFIX, is_columnar, read_metadata, read_table
+from model_inference.telemetry_utils import Telemetry, add_cache_hits
+from model_inference.template_utils import get_shard
+
+LOCAL_BATCH_WINDOW = 32
+INSTANCE_COLUMNS = ['query', 'A', 'B', 'C', 'answer_abc', 'sample_id']
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--data-path', type=str, required=True)
+    parser.add_argument('--data-path', type=str, required=True,
+                        help=f'json or columnar ({COLUMNAR_SUFFIX}) file written by 1_preprocess.py')
     parser.add_argument('--model-name', type=str, required=True)
     parser.add_argument('--output-dir', type=str, default='outputs')
     parser.add_argument('--max-tokens', type=int, default=30)
+    parser.add_argument('--short-answer', action='store_true',
+                        help='stop after the answer letter: stop sequences and a few tokens for APIs (plus letter logit bias for GPT), letter-only decoding for local models; overrides --max-tokens')
+    parser.add_argument('--stream', action='store_true',
+                        help='for GPT and Claude, stream completions and close the stream once the answer is decided')
+    parser.add_argument('--model-path', type=str, default=None,
+                        help='local weights for local models instead of the hub model')
     parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--max-batch-tokens', type=int, default=16384,
+                        help='padded prompt tokens per batch for local models')
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help='number of in-flight requests for API-backed models')
+    parser.add_argument('--rpm', type=int, default=None, help='requests per minute budget')
+    parser.add_argument('--tpm', type=int, default=None, help='tokens per minute budget')
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='keep-alive connections to the API; defaults to --num-workers')
+    parser.add_argument('--request-timeout', type=float, default=None,
+                        help='seconds to wait for an API response; defaults to the timeout of the backend')
+    parser.add_argument('--cache-path', type=str, default=None,
+                        help='sqlite file caching completions across runs')
+    parser.add_argument('--cache-max-size', type=int, default=1024,
+                        help='cache size limit in MB; least recently used entries are evicted')
+    parser.add_argument('--scoring', type=str, default=None, choices=SCORING_MODES,
+                        help='for local models, pick the choice with the highest log-likelihood instead of generating')
+    parser.add_argument('--kv-reuse', type=str, default=None, choices=['prefix', 'context'],
+                        help='for local models, compute the past key/values of the shared instruction prefix (and context) once')
+    parser.add_argument('--trace-path', type=str, default=None,
+                        help='jsonl file with one record per request: latency, queue wait, retries, errors, tokens, batch size')
+    parser.add_argument('--metrics-path', type=str, default=None,
+                        help='prometheus textfile with request counts, rolling requests/sec and latency quantiles')
+    parser.add_argument('--metrics-window', type=float, default=60., help='seconds of the rolling metrics')
+    parser.add_argument('--num-shards', type=int, default=1, help='split the guids into shards by their hash')
+    parser.add_argument('--shard-index', type=int, default=0, help='shard to run; each shard has its own predictions file')
+    parser.add_argument('--merge', action='store_true',
+                        help='merge the predictions files of all --num-shards shards, checking that every guid is there once')
+    parser.add_argument('--preprocessed-tsv-path', type=str, default=None,
+                        help='with --merge, check the guids against this file instead of --data-path')
     args = parser.parse_args()
     return args
 
 
+def get_response(prompt, model_name, max_tokens, batch_size, koalpaca=None, max_batch_tokens=16384, prefix_cache=None, short_answer=False, stream_choices=None):
+    result = generate(
+        dict(enumerate(prompt)),
+        model_name,
+        max_tokens,
+        batch_size=batch_size,
+        pipe=koalpaca,
+        max_batch_tokens=max_batch_tokens,
+        prefix_cache=prefix_cache,
+        short_answer=short_answer,
+        stream_choices=dict(enumerate(stream_choices)) if stream_choices else None
+    )
+    return [result[i] for i in range(len(prompt))]
+
+
+def get_cached_response(prompt, model_name, max_tokens, batch_size, koalpaca=None, cache=None, max_batch_tokens=16384, prefix_cache=None, short_answer=False, stream_choices=None):
+    if cache is None:
+        return get_response(prompt, model_name, max_tokens, batch_size, koalpaca, max_batch_tokens, prefix_cache, short_answer, stream_choices)
+
+    # claude is called without greedy decoding
+    greedy = model_name not in CLAUDE_MODEL
+    # short and cut (streamed) answers are cached under their own model key
+    cache_model_name = model_name + (':short' if short_answer else '') + (':stream' if stream_choices else '')
+
+    result = [cache.get(cache_model_name, p, max_tokens, greedy) for p in prompt]
+    missing = [i for i, r in enumerate(result) if r is None]
+    add_cache_hits(len(prompt) - len(missing))
+    if missing:
+        responses = get_response([prompt[i] for i in missing], model_name, max_tokens, batch_size, koalpaca, max_batch_tokens, prefix_cache, short_answer,
+                                 [stream_choices[i] for i in missing] if stream_choices else None)
+        for i, response in zip(missing, responses):
+            result[i] = response
+            cache.set(cache_model_name, prompt[i], max_tokens, greedy, response)
+
+    return result
+
+
+def get_scores(prompt, choices, model_name, scoring, batch_size, koalpaca=None, max_batch_tokens=16384, prefix_cache=None):
+    if model_name not in KOALPACA_MODEL:
+        raise NotImplementedError(f'{model_name} does not support scoring')
+
+    result = load_backend(model_name).get_koalpaca_scores(
+        dict(enumerate(prompt)),
+        dict(enumerate(choices)),
+        model_name,
+        koalpaca,
+        scoring=scoring,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        prefix_cache=prefix_cache
+    )
+    return [result[i] for i in range(len(prompt))]
+
+
+def get_cached_scores(prompt, choices, model_name, scoring, batch_size, koalpaca=None, cache=None, max_batch_tokens=16384, prefix_cache=None):
+    if cache is None:
+        return get_scores(prompt, choices, model_name, scoring, batch_size, koalpaca, max_batch_tokens, prefix_cache)
+
+    # scores are cached next to completions under their own model key; the choices are part of the prompt
+    cache_model_name = f'{model_name}:{scoring}'
+    result = [cache.get(cache_model_name, p, 0, True) for p in prompt]
+    result = [json.loads(r) if r is not None else None for r in result]
+    missing = [i for i, r in enumerate(result) if r is None]
+    add_cache_hits(len(prompt) - len(missing))
+    if missing:
+        scores = get_scores([prompt[i] for i in missing], [choices[i] for i in missing], model_name, scoring, batch_size, koalpaca, max_batch_tokens, prefix_cache)
+        for i, score in zip(missing, scores):
+            result[i] = score
+            cache.set(cache_model_name, prompt[i], 0, True, json.dumps(score))
+
+    return result
+
+
+def load_data(data_path):
+    # columnar files keep the prefix in their metadata and only the needed columns are read
+    if is_columnar(data_path):
+        return read_metadata(data_path)['prefix'], read_table(data_path, columns=INSTANCE_COLUMNS).values.tolist()
+
+    data = json.load(open(data_path, 'r', encoding='utf-8'))
+    return data['prefix'], data['data']
+
+
+def scores_to_rows(scores):
+    # the best choice goes to raw, so that post-processing reads it as is
+    return [[max(score, key=score.get), json.dumps(score)] for score in scores]
+
+
+def get_shard_path(output_path, shard_index, num_shards):
+    return output_path.with_name(f'{output_path.stem}.{shard_index}-of-{num_shards}{output_path.suffix}')
+
+
+def run_inference(instances, prefix, topic, model_name, writer, args, koalpaca=None, cache=None, prefix_cache=None, telemetry=None):
+    # local models get many batches' worth of prompts at once to bucket them by length
+    group_size = args.batch_size * LOCAL_BATCH_WINDOW if model_name in KOALPACA_MODEL else args.batch_size
+    batches = [instances[i:i + group_size] for i in range(0, len(instances), group_size)]
+
+    def traced(func, instances):
+        if telemetry is None:
+            return func
+        return telemetry.wrap(func, model=model_name, topic=topic, batch_size=len(instances))
+
+    # requests are sent concurrently and written as they complete; each row is keyed by guid
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        if args.scoring:
+            futures = {
+                executor.submit(
+                    traced(get_cached_scores, instances),
+                    [prefix + instance[0] for instance in instances],
+                    [instance[1:4] for instance in instances],
+                    model_name,
+                    args.scoring,
+                    args.batch_size,
+                    koalpaca,
+                    cache,
+                    args.max_batch_tokens,
+                    prefix_cache
+                ): instances
+                for instances in batches
+            }
+        else:
+            futures = {
+                executor.submit(
+                    traced(get_cached_response, instances),
+                    [prefix + instance[0] for instance in instances],
+                    model_name,
+                    args.max_tokens,
+                    args.batch_size,
+                    koalpaca,
+                    cache,
+                    args.max_batch_tokens,
+                    prefix_cache,
+                    args.short_answer,
+                    [instance[1:4] for instance in instances] if args.stream else None
+                ): instances
+                for instances in batches
+            }
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures), desc=model_name):
+                result = future.result()
+                if args.scoring:
+                    writer.write([datetime.now(), topic, instance[-1], instance[-2], *row]
+                                 for instance, row in zip(futures[future], scores_to_rows(result)))
+                else:
+                    writer.write([datetime.now(), topic, instance[-1], instance[-2], result[i]]
+                                 for i, instance in enumerate(futures[future]))
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
 if __name__ == "__main__":
     args = parse_args()
 
-    if not args.data_path.endswith('.json'):
+    data_path = Path(args.data_path)
+    if data_path.suffix not in ['.json', COLUMNAR_SUFFIX]:
         raise ValueError
 
-    data_path = Path(args.data_path)
-    topic = data_path.name.replace('.json', '')
+    topic = data_path.stem
     print(topic)
     
     model_name = args.model_name
@@ -48,83 +243,80 @@ if __name__ == "__main__":
     if args.batch_size != 1 and model_name not in ['clova-x', 'KoAlpaca-Polyglot-12.8B']:
         raise NotImplementedError
 
-    koalpaca = None
-    if model_name in KOALPACA_MODEL: # run with GPU
-        koalpaca = load_koalpaca(model_name)
+    if args.num_workers != 1 and model_name in KOALPACA_MODEL:
+        raise NotImplementedError
+
+    if (args.scoring or args.kv_reuse) and model_name not in KOALPACA_MODEL:
+        raise NotImplementedError
+
+    if args.stream and model_name not in GPT_MODEL + CLAUDE_MODEL:
+        raise NotImplementedError
+
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError(f'shard index {args.shard_index} out of range for {args.num_shards} shards')
 
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    data = json.load(open(data_path, 'r', encoding='utf-8'))
-    prefix = data['prefix']
+    prefix, data = load_data(data_path)
 
     output_path = output_dir / f'{topic}_{model_name}_predictions.tsv'
+
+    if args.merge:
+        shard_paths = [get_shard_path(output_path, i, args.num_shards) for i in range(args.num_shards)]
+        if args.preprocessed_tsv_path:
+            guids = read_table(args.preprocessed_tsv_path, columns=['sample_id'])['sample_id'].tolist()
+        else:
+            guids = [instance[-1] for instance in data]
+        merge_predictions(shard_paths, output_path, guids)
+        print(f'{len(shard_paths)} shards merged into {output_path}')
+        sys.exit()
+
+    if args.num_shards > 1:
+        data = [instance for instance in data if get_shard(instance[-1], args.num_shards) == args.shard_index]
+        output_path = get_shard_path(output_path, args.shard_index, args.num_shards)
+        print(f'shard {args.shard_index} of {args.num_shards}: {len(data)} instances')
+
+    if args.rpm is not None or args.tpm is not None:
+        set_rate_limit(model_name, rpm=args.rpm, tpm=args.tpm)
+    if model_name not in KOALPACA_MODEL:
+        print(f'rate limit {describe_rate_limit(model_name)}')
+    set_pool_size(args.pool_size or args.num_workers)
+    if args.request_timeout is not None and model_name not in KOALPACA_MODEL:
+        set_timeout(get_backend(model_name), args.request_timeout)
+
+    cache = None
+    if args.cache_path:
+        cache = ResponseCache(args.cache_path, max_size=args.cache_max_size * 1024 * 1024)
+
+    koalpaca = None
+    if model_name in KOALPACA_MODEL: # run with GPU
+        koalpaca = load_backend(model_name).load_koalpaca(model_name, args.model_path)
+
+    prefix_cache = load_backend(model_name).PrefixCache(args.kv_reuse) if args.kv_reuse else None
+
     if output_path.is_file():
         print(f'Continue on {output_path}')
-        done_ids = pd.read_csv(output_dir / f'{topic}_{model_name}_predictions.tsv', sep='\t')['guid'].to_list()
-    else:
-        done_ids = []
-        with open(output_dir / f'{topic}_{model_name}_predictions.tsv', 'w', encoding='utf-8') as f:
-            writer = csv.writer(f, delimiter='\t')
-            writer.writerow(['time', 'topic', 'guid', 'truth', 'raw'])
-
-    for i in tqdm(range(0, len(data['data']), args.batch_size), desc=model_name):
-        # instance: prompt, A, B, C, truth, guid
-        instances = [data['data'][j] for j in range(i, min(i + args.batch_size, len(data['data']))) if data['data'][j][-1] not in done_ids]
-
-        if not instances:
-            continue
-
-        prompt = [prefix + instance[0] for instance in instances]
-
-        if model_name in GPT_MODEL:
-            result = [get_gpt_response(
-                prompt[0],
-                model_name,
-                max_tokens=args.max_tokens,
-                greedy=True
-            )]
-        elif model_name in HYPERCLOVA_MODEL:
-            result = get_hyperclova_response(
-                prompt,
-                model_name,
-                max_tokens=args.max_tokens,
-                greedy=True
-            )
-        elif model_name in CLAUDE_MODEL:
-            result = [get_claude_response(
-                prompt[0],
-                model_name,
-                max_tokens=args.max_tokens
-            )]
-        elif model_name in KOALPACA_MODEL:
-            result = get_koalpaca_response(
-                prompt,
-                model_name,
-                koalpaca,
-                max_tokens=args.max_tokens,
-                batch_size=args.batch_size
-            )
-        else:
-            raise ValueError(model_name)
-
-        for i, instance in enumerate(instances):
-            open_trial = 0
-            while True:
-                if open_trial >= 10:
-                    raise Exception("File Open Fail")
-
-                try:
-                    with open(output_dir / f"{topic}_{model_name}_predictions.tsv", "a", encoding="utf-8") as f:
-                        writer = csv.writer(f, delimiter='\t')
-                        writer.writerow([datetime.now(), topic, instance[-1], instance[-2], result[i]])
-                    break
-                except KeyboardInterrupt:
-                    raise Exception("Keyboard Interrupt")
-                except:
-                    print("open failed")
-                    open_trial += 1
-                    continue
+    header = ['time', 'topic', 'guid', 'truth', 'raw'] + (['scores'] if args.scoring else [])
+    writer = PredictionWriter(output_path, header, key='guid')
+
+    # instance: prompt, A, B, C, truth, guid
+    instances = [instance for instance in data if instance[-1] not in writer.done]
+
+    telemetry = None
+    if args.trace_path or args.metrics_path:
+        telemetry = Telemetry(args.trace_path, args.metrics_path, window=args.metrics_window)
+
+    with writer:
+        run_inference(instances, prefix, topic, model_name, writer, args, koalpaca, cache, prefix_cache, telemetry)
+
+    if telemetry is not None:
+        telemetry.close()
+
+    if cache is not None:
+        print(f'cache {cache.stats()}')
+        cache.close()
+    if prefix_cache is not None:
+        print(f'kv reuse {prefix_cache.stats()}')
 
     print(f"{topic} - {model_name} done")
-    
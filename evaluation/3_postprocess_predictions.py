@@ -10,116 +10,82 @@ import math
 import json
 import argparse
 import pandas as pd
-from tqdm import tqdm
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from model_inference.answer_utils import raw2prediction_batch
+from model_inference.table_utils import read_table, write_table
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--predictions-tsv-path", type=str, required=True)
-    parser.add_argument("--preprocessed-tsv-path", type=str, required=True)
+    parser.add_argument("--preprocessed-tsv-path", type=str, required=True, help="tsv or columnar (.kbq) file")
+    parser.add_argument("--output-path", type=str, default=None,
+                        help="tsv or columnar (.kbq) file; the predictions tsv is overwritten by default")
     parser.add_argument("--ooc-path", type=str, default=None)
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="processes extracting the answers, each from its own chunks of the predictions")
     args = parser.parse_args()
     return args
 
 
-def raw2prediction(raw, choices):
-    try:
-        prediction = re.search('^\s*\(?(?P<raw>[^\.\n]*)\s*', raw).groupdict()['raw']
-    except:
-        prediction = ''
-        
-    prediction = prediction.replace('없습니다', '없음').replace('입니다', '')
-    
-    prediction_upper = prediction.upper()
-
-    if prediction_upper and (prediction_upper[0] in choices.keys()): # starts with A, B, C
-        try:
-            choice = re.search('[:)]\s*(?P<choice>.*)\s*', prediction_upper).groupdict()['choice'].strip()
-            
-            if len(choice) == 0:
-                raise Exception
-            
-            if choices[prediction_upper[0]] == choice.lower():
-                return prediction_upper[0]
-            elif sum(prediction_upper.count(choice.upper()) for choice in choices.values()) > 1: # out-of-choice
-                return prediction
-            else:
-                # print(f"'{prediction_upper[0]}' should be '{choices[prediction_upper[0]]}', but '{prediction}' found")
-                return prediction_upper[0]
-            
-        except:
-            if sum(prediction_upper.count(alphabet) for alphabet in choices.keys()) == 1:
-                prediction = prediction_upper[0]
-                return prediction
-        
-    if prediction.lower() in choices.values(): # one of choices
-        return list(choices.keys())[list(choices.values()).index(prediction.lower())]
-    
-    else:
-        try:
-            raw = re.search('\*\*[\'\"]?(?P<answer>[^\.\n\*\'\"]*)\s*', raw).groupdict()['answer']
-            return raw2prediction(raw, choices)
-        except:
-            pass
-        
-        try:
-            raw = re.search('답변?[은:]\s*[\'\"]?(?P<answer>[^\.\n\*\'\"]*)\s*', raw).groupdict()['answer']
-            return raw2prediction(raw, choices)
-        except:
-            pass
-        
-        try:
-            raw = re.search('[\'\"](?P<answer>[^\.\n\*\'\"]*)\s*', raw).groupdict()['answer']
-            return raw2prediction(raw, choices)
-        except:
-            pass
-        
-        raw_upper = raw.upper()
-        count = 0
-        answer_alphabet = ''
-        for alphabet, choice in choices.items():
-            if len(re.findall(f'{alphabet}[:)]', raw_upper)) > 0:
-                answer_alphabet = alphabet
-                count += 1
-        if count == 1:
-            return answer_alphabet
-        
-        return raw
-
-
-def postprocess(x_result, df_processed, ooc_path=None):
-    x_processed = df_processed[df_processed['sample_id'] == x_result.guid]
-    
-    if len(x_processed) == 0:
-        raise ValueError(f"{x_result.guid} Not Found")
+def merge_processed(df_result, df_processed):
+    duplicated = df_processed.loc[df_processed['sample_id'].duplicated(), 'sample_id'].unique()
+    if len(duplicated) > 0:
+        raise ValueError(f"{len(duplicated)} duplicated sample_id in preprocessed tsv: {', '.join(duplicated)}")
+
+    df_choices = df_processed[['sample_id', 'A', 'B', 'C']].rename(columns={'sample_id': 'guid'})
+    df = df_result.drop(columns=['A', 'B', 'C'], errors='ignore').merge(df_choices, on='guid', how='left', indicator=True)
+
+    not_found = df.loc[df['_merge'] == 'left_only', 'guid']
+    if len(not_found) > 0:
+        raise ValueError(f"{', '.join(not_found)} Not Found")
+
+    return df.drop(columns='_merge')
+
+
+def extract_predictions(df, num_workers=1):
+    if num_workers <= 1:
+        return raw2prediction_batch(df['raw'], df)
     
-    choices = {'A': x_processed.A.item().lower(), 'B': x_processed.B.item().lower(), 'C': x_processed.C.item().lower()}
+    # a few chunks per worker; each keeps its index, so the concatenation is in the original order
+    chunk_size = max(1, math.ceil(len(df) / (num_workers * 4)))
+    chunks = [df.iloc[i:i + chunk_size][['raw', 'A', 'B', 'C']] for i in range(0, len(df), chunk_size)]
+    if not chunks:
+        return raw2prediction_batch(df['raw'], df)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return pd.concat(executor.map(raw2prediction_batch, [chunk['raw'] for chunk in chunks], chunks))
+
+
+def postprocess(df_result, df_processed, ooc_path=None, num_workers=1):
+    df = merge_processed(df_result, df_processed)
     
-    prediction = raw2prediction(x_result.raw, choices)
+    predictions = extract_predictions(df, num_workers)
     
-    if prediction not in ['A', 'B', 'C'] and ooc_path:
+    if ooc_path:
+        df_ooc = df[~predictions.isin(['A', 'B', 'C'])]
         with open(ooc_path, 'a', encoding='utf-8') as f:
             writer = csv.writer(f, delimiter='\t')
-            writer.writerow([x_result.guid, choices, x_result.raw, prediction])
+            writer.writerows([guid, {'A': A.lower(), 'B': B.lower(), 'C': C.lower()}, raw, prediction]
+                             for guid, A, B, C, raw, prediction
+                             in zip(df_ooc['guid'], df_ooc['A'], df_ooc['B'], df_ooc['C'], df_ooc['raw'], predictions[df_ooc.index]))
     
-    return prediction
+    return predictions.values
 
 
 def main(args):
-    tqdm.pandas()
-    
     if args.ooc_path:
         Path(args.ooc_path).parent.mkdir(parents=True, exist_ok=True)
         with open(args.ooc_path, 'w', encoding='utf-8') as f:
             writer = csv.writer(f, delimiter='\t')
             writer.writerow(['id', 'choices', 'raw', 'processed'])
     
-    df_result = pd.read_csv(args.predictions_tsv_path, delimiter='\t')
-    df_processed = pd.read_csv(args.preprocessed_tsv_path, delimiter='\t')
+    df_result = read_table(args.predictions_tsv_path)
+    df_processed = read_table(args.preprocessed_tsv_path, columns=['sample_id', 'A', 'B', 'C'])
 
-    df_result['prediction'] = df_result.progress_apply(lambda x: postprocess(x, df_processed, args.ooc_path), axis=1)
-    df_result.to_csv(args.predictions_tsv_path, sep='\t', index=False)
+    df_result['prediction'] = postprocess(df_result, df_processed, args.ooc_path, args.num_workers)
+    write_table(df_result, args.output_path or args.predictions_tsv_path)
     
     print('out-of-choice count', (~df_result['prediction'].isin(['A', 'B', 'C'])).sum())
 
@@ -7,48 +7,52 @@ MIT license
 import csv
 import argparse
 import pandas as pd
-from tqdm import tqdm
 from pathlib import Path
 
+from model_inference.table_utils import read_table, write_table
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--predictions-tsv-path", type=str, required=True)
-    parser.add_argument("--preprocessed-tsv-path", type=str, required=True)
-    parser.add_argument("--output-path", type=str, required=True)
+    parser.add_argument("--predictions-tsv-path", type=str, required=True, help="tsv or columnar (.kbq) file")
+    parser.add_argument("--preprocessed-tsv-path", type=str, required=True, help="tsv or columnar (.kbq) file")
+    parser.add_argument("--output-path", type=str, required=True, help="tsv or columnar (.kbq) file")
     args = parser.parse_args()
     return args
 
 
-def abc_2_prediction(x_processed, df_result):
-    pred = df_result[df_result.guid == x_processed.sample_id].prediction
-    
-    if len(pred) == 1:
-        pred = pred.item()
-    elif len(pred) == 0:
-        raise ValueError(f"{x_processed.sample_id} Not Found")
-    else:
-        raise ValueError(f"{len(pred)} {x_processed.sample_id} Found")
+def abc_2_prediction(df_evaluation, df_result):
+    counts = df_result['guid'].value_counts()
+    duplicated = counts[counts > 1]
+    if len(duplicated) > 0:
+        raise ValueError(', '.join(f"{count} {guid} Found" for guid, count in duplicated.items()))
+
+    df = df_evaluation.drop(columns='prediction', errors='ignore').merge(
+        df_result[['guid', 'prediction']].rename(columns={'guid': 'sample_id'}),
+        on='sample_id', how='left', indicator=True
+    )
+
+    not_found = df.loc[df['_merge'] == 'left_only', 'sample_id']
+    if len(not_found) > 0:
+        raise ValueError(f"{', '.join(not_found)} Not Found")
 
-    if pred in ['A', 'B', 'C']:
-        pred = x_processed[pred]
+    pred = df['prediction'].astype(object)
+    for alphabet in ['A', 'B', 'C']:
+        pred = pred.mask(df['prediction'] == alphabet, df[alphabet])
 
-    return pred
+    return pred.values
 
 
 def to_model_evaluation_tsv(df, output_path):
-    output_path = Path(output_path)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(output_path, sep='\t', index=False)
+    write_table(df, output_path)
 
 
 def main(args):
-    tqdm.pandas()
-    
-    df_result = pd.read_csv(args.predictions_tsv_path, delimiter='\t')
-    df_evaluation = pd.read_csv(args.preprocessed_tsv_path, delimiter='\t')
+    df_result = read_table(args.predictions_tsv_path, columns=['guid', 'prediction'])
+    # columnar pre-processed files also hold the queries
+    df_evaluation = read_table(args.preprocessed_tsv_path).drop(columns='query', errors='ignore')
 
-    df_evaluation['prediction'] = df_evaluation.progress_apply(lambda x: abc_2_prediction(x, df_result), axis=1)
+    df_evaluation['prediction'] = abc_2_prediction(df_evaluation, df_result)
 
     to_model_evaluation_tsv(df_evaluation, args.output_path)
 
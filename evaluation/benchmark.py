@@ -0,0 +1,227 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import json
+import time
+import random
+import hashlib
+import argparse
+import resource
+import threading
+import importlib.util
+import multiprocessing
+import pandas as pd
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from model_inference.checkpoint_utils import PredictionWriter
+from model_inference.rate_limit_utils import call_with_retry
+from model_inference.table_utils import COLUMNAR_SUFFIX, ColumnarWriter, read_table, write_table
+
+
+def load_script(name):
+    path = Path(__file__).parent / f'{name}.py'
+    spec = importlib.util.spec_from_file_location(name.split('_', 1)[-1], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+preprocess = load_script('1_preprocess')
+inference = load_script('2_model_inference')
+postprocess = load_script('3_postprocess_predictions')
+to_evaluation = load_script('4_predictions_to_evaluation')
+evaluation = load_script('5_evaluation')
+
+STAGES = ['preprocess', 'inference', 'postprocess', 'to_evaluation', 'evaluation']
+FAKE_MODEL = 'fake'
+# letters in the formats the extractor handles, and one out-of-choice answer
+FAKE_ANSWERS = ['A', '(B)', 'C: ', 'b', '모르겠습니다.']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples-tsv-path', type=str, default='../data/KoBBQ_test_samples.tsv')
+    parser.add_argument('--prompt-tsv-path', type=str, default='0_evaluation_prompts.tsv')
+    parser.add_argument('--prompt-id', type=int, default=1)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100],
+                        help='number of copies of the samples, each with its own template ids')
+    parser.add_argument('--output-dir', type=str, default='outputs/benchmark')
+    parser.add_argument('--report-path', type=str, default='outputs/benchmark/report.json')
+    parser.add_argument('--format', type=str, default='.tsv', choices=['.tsv', COLUMNAR_SUFFIX],
+                        help='format of the intermediate files')
+    parser.add_argument('--test-or-all', type=str, default='test')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='mean seconds per request of the fake backend (exponentially distributed)')
+    parser.add_argument('--failure-rate', type=float, default=0.,
+                        help='fraction of fake requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=0.01,
+                        help='Retry-After seconds of the fake 429 responses')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--num-workers', type=int, default=8)
+    parser.add_argument('--postprocess-workers', type=int, default=1, help='processes of the post-processing step')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+
+class FakeRateLimitError(Exception):
+    def __init__(self, retry_after):
+        super().__init__('fake rate limit')
+        self.http_status = 429
+        self.headers = {'retry-after': str(retry_after)}
+
+
+class FakeBackend:
+    # stands in for get_response; answers depend only on the prompt, failures go through the shared retry policy
+    def __init__(self, latency=0., failure_rate=0., retry_after=0.01, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_failures = 0
+
+    def answer(self, prompt):
+        digest = hashlib.md5(prompt.encode('utf-8')).digest()
+        return FAKE_ANSWERS[digest[0] % len(FAKE_ANSWERS)]
+
+    def request(self, prompt):
+        with self.lock:
+            self.n_requests += 1
+            latency = self.random.expovariate(1 / self.latency) if self.latency else 0
+            failed = self.random.random() < self.failure_rate
+            self.n_failures += failed
+        time.sleep(latency)
+        if failed:
+            raise FakeRateLimitError(self.retry_after)
+        return [self.answer(p) for p in prompt]
+
+    def __call__(self, prompt, model_name, max_tokens, batch_size, koalpaca=None, max_batch_tokens=16384, prefix_cache=None, short_answer=False, stream_choices=None):
+        return call_with_retry(lambda: self.request(prompt), model_name, max_try=100)
+
+
+def make_samples(df, scale):
+    # copy r gets template ids shifted by 1000 * r, so that every copy is a new set of templates
+    copies = []
+    for r in range(scale):
+        df_copy = df.copy()
+        sample_id = df_copy['sample_id'].str.split('-', n=2, expand=True)
+        template = (sample_id[1].str[:-1].astype(int) + 1000 * r).astype(str).str.zfill(3)
+        df_copy['sample_id'] = sample_id[0] + '-' + template + sample_id[1].str[-1] + '-' + sample_id[2]
+        copies.append(df_copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def get_paths(output_dir, scale, suffix):
+    directory = Path(output_dir) / f'x{scale}'
+    return {
+        'samples': directory / f'samples{suffix}',
+        'preprocessed': directory / f'preprocessed{suffix}',
+        'data': directory / ('data.json' if suffix == '.tsv' else f'data{suffix}'),
+        'predictions': directory / 'predictions.tsv',
+        'result': directory / f'result{suffix}',
+    }
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(stage, paths, args):
+    # runs in a fresh process, so that the peak memory belongs to this stage only
+    df_prompts = pd.read_csv(args.prompt_tsv_path, sep='\t')
+    unk_ans = df_prompts[df_prompts['prompt_id'] == args.prompt_id]['unknown'].item()
+    stats = {}
+
+    if stage == 'preprocess':
+        df = read_table(paths['samples'])
+        n_rows = len(df) * 3
+        run = lambda: preprocess.process(df, df_prompts, args.prompt_id)
+    else:
+        n_rows = len(read_table(paths['preprocessed'], columns=['sample_id']))
+
+    if stage == 'inference':
+        prefix, instances = inference.load_data(paths['data'])
+        paths['predictions'].unlink(missing_ok=True)
+        backend = FakeBackend(args.latency, args.failure_rate, args.retry_after, args.seed)
+        inference.get_response = backend
+        inference_args = argparse.Namespace(batch_size=args.batch_size, num_workers=args.num_workers, scoring=None,
+                                            max_tokens=30, max_batch_tokens=16384, short_answer=False, stream=False)
+
+        def run():
+            with PredictionWriter(paths['predictions'], ['time', 'topic', 'guid', 'truth', 'raw'], key='guid') as writer:
+                inference.run_inference(instances, prefix, 'benchmark', FAKE_MODEL, writer, inference_args)
+    elif stage == 'postprocess':
+        run = lambda: postprocess.main(argparse.Namespace(
+            predictions_tsv_path=paths['predictions'], preprocessed_tsv_path=paths['preprocessed'], output_path=None, ooc_path=None,
+            num_workers=args.postprocess_workers))
+    elif stage == 'to_evaluation':
+        run = lambda: to_evaluation.main(argparse.Namespace(
+            predictions_tsv_path=paths['predictions'], preprocessed_tsv_path=paths['preprocessed'], output_path=paths['result']))
+    elif stage == 'evaluation':
+        run = lambda: evaluation.evaluate_model(FAKE_MODEL, paths['result'], args.test_or_all, unk_ans)
+    elif stage != 'preprocess':
+        raise ValueError(stage)
+
+    baseline = max_rss_mb()
+    start = time.perf_counter()
+    output = run()
+    wall_time = time.perf_counter() - start
+    peak = max_rss_mb()
+
+    if stage == 'preprocess':
+        df_prompt, prefix = output
+        write_table(df_prompt.drop(columns='query'), paths['preprocessed'])
+        if args.format == COLUMNAR_SUFFIX:
+            with ColumnarWriter(paths['data'], {'ver': 'test', 'prefix': prefix}) as writer:
+                writer.write(df_prompt)
+        else:
+            writer = preprocess.JsonWriter(paths['data'], prefix)
+            writer.write(df_prompt)
+            writer.close()
+    elif stage == 'inference':
+        stats = {'requests': backend.n_requests, 'failures': backend.n_failures}
+
+    return {
+        'stage': stage,
+        'rows': n_rows,
+        'wall_time': wall_time,
+        'rows_per_sec': n_rows / wall_time if wall_time > 0 else None,
+        'baseline_memory_mb': baseline,
+        'peak_memory_mb': peak,
+        **stats
+    }
+
+
+def main(args):
+    df_samples = read_table(args.samples_tsv_path)
+    context = multiprocessing.get_context('spawn')
+
+    report = {'args': vars(args), 'results': []}
+    for scale in args.scales:
+        paths = get_paths(args.output_dir, scale, args.format)
+        paths['samples'].parent.mkdir(parents=True, exist_ok=True)
+        write_table(make_samples(df_samples, scale), paths['samples'])
+
+        for stage in STAGES:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_stage, stage, paths, args).result()
+            result['scale'] = scale
+            report['results'].append(result)
+            print(f"x{scale} {stage}: {result['rows']} rows in {result['wall_time']:.2f}s, peak {result['peak_memory_mb']:.0f}MB")
+
+    report_path = Path(args.report_path)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,341 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import argparse
+import importlib.util
+import pandas as pd
+
+from pathlib import Path
+from tqdm.auto import tqdm
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from model_inference.answer_utils import raw2prediction_batch
+from model_inference.backend_utils import GPT_MODEL, CLAUDE_MODEL, HYPERCLOVA_MODEL, KOALPACA_MODEL, SCORING_MODES, get_backend, load_backend
+from model_inference.cache_utils import ResponseCache
+from model_inference.checkpoint_utils import PredictionWriter
+from model_inference.rate_limit_utils import describe_rate_limit, set_rate_limit
+from model_inference.session_utils import set_pool_size, set_timeout
+from model_inference.template_utils import iter_sample_chunks
+from model_inference.table_utils import ColumnarWriter, is_columnar, iter_table
+from model_inference.telemetry_utils import Telemetry
+
+
+def load_script(name):
+    path = Path(__file__).parent / f'{name}.py'
+    spec = importlib.util.spec_from_file_location(name.split('_', 1)[-1], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+preprocess = load_script('1_preprocess')
+inference = load_script('2_model_inference')
+evaluation = load_script('5_evaluation')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--samples-tsv-path', type=str, help='samples tsv or columnar (.kbq) file')
+    source.add_argument('--templates-tsv-path', type=str,
+                        help='expand the templates into samples on the fly instead of reading a samples tsv; '
+                             'a superset of KoBBQ_all_samples.tsv, not for reported scores')
+    parser.add_argument('--prompt-tsv-path', type=str, required=True)
+    parser.add_argument('--prompt-id', type=int, nargs='+', required=True)
+    parser.add_argument('--models', nargs='+', required=True)
+    parser.add_argument('--test-or-all', type=str, required=True)
+    parser.add_argument('--evaluation-result-path', type=str, required=True)
+    parser.add_argument('--topic', type=str, default='KoBBQ')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='number of samples held in memory at a time')
+    parser.add_argument('--num-shards', type=int, default=1, help='with --templates-tsv-path')
+    parser.add_argument('--shard-index', type=int, default=0, help='with --templates-tsv-path')
+    parser.add_argument('--sample-rate', type=float, default=None,
+                        help='with --templates-tsv-path, keep this fraction of the samples')
+    parser.add_argument('--seed', type=int, default=0, help='with --sample-rate')
+    parser.add_argument('--max-tokens', type=int, default=30)
+    parser.add_argument('--short-answer', action='store_true',
+                        help='stop after the answer letter; see 2_model_inference.py')
+    parser.add_argument('--stream', action='store_true',
+                        help='for GPT and Claude, stream completions and close the stream once the answer is decided')
+    parser.add_argument('--model-path', type=str, default=None,
+                        help='local weights for local models instead of the hub model')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--max-batch-tokens', type=int, default=16384)
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--rpm', type=int, default=None, help='requests per minute budget of each model')
+    parser.add_argument('--tpm', type=int, default=None, help='tokens per minute budget of each model')
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='keep-alive connections to each API; defaults to --num-workers')
+    parser.add_argument('--request-timeout', type=float, default=None,
+                        help='seconds to wait for an API response; defaults to the timeout of each backend')
+    parser.add_argument('--cache-path', type=str, default=None)
+    parser.add_argument('--cache-max-size', type=int, default=1024)
+    parser.add_argument('--scoring', type=str, default=None, choices=SCORING_MODES,
+                        help='for local models, pick the choice with the highest log-likelihood instead of generating')
+    parser.add_argument('--kv-reuse', type=str, default=None, choices=['prefix', 'context'],
+                        help='for local models, compute the past key/values of the shared instruction prefix (and context) once')
+    parser.add_argument('--trace-path', type=str, default=None,
+                        help='jsonl file with one record per request: latency, queue wait, retries, errors, tokens, batch size')
+    parser.add_argument('--metrics-path', type=str, default=None,
+                        help='prometheus textfile with request counts, rolling requests/sec and latency quantiles')
+    parser.add_argument('--metrics-window', type=float, default=60., help='seconds of the rolling metrics')
+    # optional intermediate artifacts; {prompt_id} and {model} are filled in
+    parser.add_argument('--evaluation-tsv-path', type=str, default=None,
+                        help='pre-processed samples, as written by 1_preprocess.py; tsv or columnar (.kbq)')
+    parser.add_argument('--predictions-tsv-path', type=str, default=None,
+                        help='raw predictions, as written by 2_model_inference.py')
+    parser.add_argument('--model-result-tsv-path', type=str, default=None,
+                        help='samples with predictions, as written by 4_predictions_to_evaluation.py; tsv or columnar (.kbq)')
+    args = parser.parse_args()
+    return args
+
+
+def read_samples(args):
+    if args.templates_tsv_path:
+        yield from iter_sample_chunks(
+            args.templates_tsv_path,
+            args.chunk_size,
+            num_shards=args.num_shards,
+            shard_index=args.shard_index,
+            sample_rate=args.sample_rate,
+            seed=args.seed
+        )
+        return
+
+    yield from iter_table(args.samples_tsv_path, args.chunk_size)
+
+
+def preprocess_stream(chunks, df_prompts, prompt_ids):
+    for df in chunks:
+        if df.empty:
+            continue
+        for prompt_id, df_prompt, prefix in preprocess.process_all(df, df_prompts, prompt_ids):
+            yield prompt_id, df_prompt, prefix
+
+
+def read_done_raws(writer):
+    # raws of the rows already in the predictions file, which a rerun does not request again
+    if writer is None or not writer.done:
+        return {}
+    writer.sync()
+    df = pd.read_csv(writer.path, sep='\t', usecols=['guid', 'raw'], dtype=str, keep_default_na=False)
+    return dict(zip(df['guid'], df['raw']))
+
+
+def infer(df, prefix, model_name, args, executor, topic, koalpaca=None, cache=None, writer=None, prefix_cache=None, telemetry=None, done=None):
+    # done: {guid: raw} of the rows that are not run again
+    done = done or {}
+    instances = [instance for instance in df[['query', 'A', 'B', 'C', 'answer_abc', 'sample_id']].values.tolist() if instance[-1] not in done]
+    group_size = args.batch_size * inference.LOCAL_BATCH_WINDOW if koalpaca is not None else args.batch_size
+    batches = [instances[i:i + group_size] for i in range(0, len(instances), group_size)]
+
+    def traced(func, batch):
+        if telemetry is None:
+            return func
+        return telemetry.wrap(func, model=model_name, topic=topic, batch_size=len(batch))
+
+    if args.scoring:
+        futures = [
+            executor.submit(
+                traced(inference.get_cached_scores, batch),
+                [prefix + instance[0] for instance in batch],
+                [instance[1:4] for instance in batch],
+                model_name,
+                args.scoring,
+                args.batch_size,
+                koalpaca,
+                cache,
+                args.max_batch_tokens,
+                prefix_cache
+            )
+            for batch in batches
+        ]
+    else:
+        futures = [
+            executor.submit(
+                traced(inference.get_cached_response, batch),
+                [prefix + instance[0] for instance in batch],
+                model_name,
+                args.max_tokens,
+                args.batch_size,
+                koalpaca,
+                cache,
+                args.max_batch_tokens,
+                prefix_cache,
+                args.short_answer,
+                [instance[1:4] for instance in batch] if args.stream else None
+            )
+            for batch in batches
+        ]
+
+    raws = dict(done)
+    for batch, future in zip(batches, futures):
+        result = future.result()
+        rows = inference.scores_to_rows(result) if args.scoring else [[raw] for raw in result]
+        raws.update((instance[-1], row[0]) for instance, row in zip(batch, rows))
+        if writer is not None:
+            writer.write([datetime.now(), topic, instance[-1], instance[-2], *row]
+                         for instance, row in zip(batch, rows) if instance[-1] not in writer.done)
+
+    return pd.Series([raws[guid] for guid in df['sample_id']], index=df.index, dtype=object)
+
+
+def postprocess(df, raws):
+    df = df.drop(columns='query')
+    predictions = raw2prediction_batch(raws, df)
+
+    # letter -> choice, as in 4_predictions_to_evaluation.py
+    df['prediction'] = predictions.astype(object)
+    for alphabet in ['A', 'B', 'C']:
+        df['prediction'] = df['prediction'].mask(predictions == alphabet, df[alphabet])
+    return df
+
+
+class TableAppender:
+    # tsv files are appended to as they go; columnar files are written on close
+    def __init__(self):
+        self.started = set()
+        self.columnar = {}
+
+    def write(self, df, path):
+        if path is None:
+            return
+        path = Path(path)
+        if is_columnar(path):
+            self.columnar.setdefault(path, ColumnarWriter(path)).write(df)
+            return
+        if path not in self.started:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            df.head(0).to_csv(path, sep='\t', index=False)
+            self.started.add(path)
+        df.to_csv(path, sep='\t', index=False, header=False, mode='a')
+
+    def close(self):
+        for writer in self.columnar.values():
+            writer.close()
+
+
+def format_path(path, **kwargs):
+    if path is None:
+        return None
+    for key, value in kwargs.items():
+        path = path.replace(f'{{{key}}}', str(value))
+    return path
+
+
+def main(args):
+    batch_models = HYPERCLOVA_MODEL.keys() | set(KOALPACA_MODEL)
+    if args.batch_size != 1 and any(model_name not in batch_models for model_name in args.models):
+        raise NotImplementedError
+    if (args.scoring or args.kv_reuse) and any(model_name not in KOALPACA_MODEL for model_name in args.models):
+        raise NotImplementedError
+    if args.stream and any(model_name not in GPT_MODEL + CLAUDE_MODEL for model_name in args.models):
+        raise NotImplementedError
+    # PrefixCache and the local pipelines are not thread-safe
+    if args.num_workers != 1 and any(model_name in KOALPACA_MODEL for model_name in args.models):
+        raise NotImplementedError
+
+    df_prompts = pd.read_csv(args.prompt_tsv_path, sep='\t')
+    unk_ans = {prompt_id: df_prompts[df_prompts['prompt_id'] == prompt_id]['unknown'].item() for prompt_id in args.prompt_id}
+
+    if args.rpm is not None or args.tpm is not None:
+        for model_name in args.models:
+            set_rate_limit(model_name, rpm=args.rpm, tpm=args.tpm)
+    for model_name in args.models:
+        if model_name not in KOALPACA_MODEL:
+            print(f'rate limit {describe_rate_limit(model_name)}')
+    set_pool_size(args.pool_size or args.num_workers)
+    if args.request_timeout is not None:
+        for model_name in args.models:
+            if model_name not in KOALPACA_MODEL:
+                set_timeout(get_backend(model_name), args.request_timeout)
+
+    cache = None
+    if args.cache_path:
+        cache = ResponseCache(args.cache_path, max_size=args.cache_max_size * 1024 * 1024)
+
+    koalpaca = {}
+    prefix_caches = {}
+    for model_name in args.models:
+        if model_name in KOALPACA_MODEL:
+            koalpaca[model_name] = load_backend(model_name).load_koalpaca(model_name, args.model_path)
+            if args.kv_reuse:
+                prefix_caches[model_name] = load_backend(model_name).PrefixCache(args.kv_reuse)
+
+    writers = {}
+    if args.predictions_tsv_path:
+        for prompt_id in args.prompt_id:
+            for model_name in args.models:
+                path = format_path(args.predictions_tsv_path, prompt_id=prompt_id, model=model_name)
+                header = ['time', 'topic', 'guid', 'truth', 'raw'] + (['scores'] if args.scoring else [])
+                writers[prompt_id, model_name] = PredictionWriter(path, header, key='guid')
+    done = {key: read_done_raws(writer) for key, writer in writers.items()}
+    tables = TableAppender()
+    telemetry = None
+    if args.trace_path or args.metrics_path:
+        telemetry = Telemetry(args.trace_path, args.metrics_path, window=args.metrics_window)
+
+    keys = ['prompt id', 'model', 'template_id', 'label_annotation', 'category']
+    counts = None
+
+    stream = preprocess_stream(read_samples(args), df_prompts, args.prompt_id)
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        for prompt_id, df_prompt, prefix in tqdm(stream, desc='chunks'):
+            df_prompt = df_prompt.reset_index(drop=True)
+            tables.write(df_prompt.drop(columns='query'), format_path(args.evaluation_tsv_path, prompt_id=prompt_id))
+
+            for model_name in args.models:
+                raws = infer(
+                    df_prompt, prefix, model_name, args, executor,
+                    topic=f'{args.topic}_{prompt_id}',
+                    koalpaca=koalpaca.get(model_name),
+                    cache=cache,
+                    writer=writers.get((prompt_id, model_name)),
+                    prefix_cache=prefix_caches.get(model_name),
+                    telemetry=telemetry,
+                    done=done.get((prompt_id, model_name))
+                )
+                df_result = postprocess(df_prompt, raws)
+                tables.write(df_result, format_path(args.model_result_tsv_path, prompt_id=prompt_id, model=model_name))
+
+                # only per-template counts are kept across chunks
+                chunk_counts = evaluation.get_counts(evaluation.annotate(df_result, unk_ans[prompt_id]))
+                chunk_counts['prompt id'] = prompt_id
+                chunk_counts['model'] = model_name
+                if counts is not None:
+                    chunk_counts = pd.concat([counts, chunk_counts], ignore_index=True)
+                counts = chunk_counts.groupby(keys, dropna=False, as_index=False)[evaluation.COUNTS].sum()
+
+    for writer in writers.values():
+        writer.close()
+    tables.close()
+    if telemetry is not None:
+        telemetry.close()
+    if cache is not None:
+        print(f'cache {cache.stats()}')
+        cache.close()
+    for model_name, prefix_cache in prefix_caches.items():
+        print(f'{model_name} kv reuse {prefix_cache.stats()}')
+
+    result_path = Path(args.evaluation_result_path)
+    result_path.parent.mkdir(parents=True, exist_ok=True)
+    columns = ['model', 'prompt id', 'category'] + evaluation.METRICS
+    if counts is None:
+        # e.g. an empty shard
+        print('No samples to evaluate')
+        pd.DataFrame(columns=columns).to_csv(result_path, sep='\t', index=False)
+        return
+
+    results = evaluation.evaluate(counts, args.test_or_all, ['prompt id', 'model'])
+    results = evaluation.sort_results(results, args.prompt_id, args.models)
+    results[columns].to_csv(result_path, sep='\t', index=False)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
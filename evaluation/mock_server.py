@@ -0,0 +1,273 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import sys
+import json
+import math
+import time
+import random
+import signal
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LATENCY_DISTRIBUTIONS = ['constant', 'exponential', 'lognormal']
+SERVER_ERRORS = [500, 502, 503]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0., help='mean seconds per request')
+    parser.add_argument('--latency-dist', type=str, default='constant', choices=LATENCY_DISTRIBUTIONS)
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='sigma of the lognormal latency')
+    parser.add_argument('--token-latency', type=float, default=0.,
+                        help='seconds per generated character, streamed one character per event')
+    parser.add_argument('--rate-limit-rate', type=float, default=0., help='fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1., help='Retry-After seconds of 429 responses')
+    parser.add_argument('--server-error-rate', type=float, default=0., help='fraction of requests answered with 5xx')
+    parser.add_argument('--answers', type=str, nargs='+', default=['A', 'B', 'C'],
+                        help='canned answers; each prompt always gets the same one')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+
+class MockBehavior:
+    # shared by all handler threads of a server
+    def __init__(self, latency=0., latency_dist='constant', latency_sigma=0.5, token_latency=0., rate_limit_rate=0.,
+                 retry_after=1., server_error_rate=0., answers=('A', 'B', 'C'), seed=0):
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.token_latency = token_latency
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.server_error_rate = server_error_rate
+        self.answers = list(answers)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def sample(self):
+        # latency and status of the next request
+        with self.lock:
+            if self.latency <= 0:
+                latency = 0.
+            elif self.latency_dist == 'exponential':
+                latency = self.random.expovariate(1 / self.latency)
+            elif self.latency_dist == 'lognormal':
+                latency = self.random.lognormvariate(math.log(self.latency) - self.latency_sigma ** 2 / 2, self.latency_sigma)
+            else:
+                latency = self.latency
+
+            p = self.random.random()
+            if p < self.rate_limit_rate:
+                status = 429
+            elif p < self.rate_limit_rate + self.server_error_rate:
+                status = self.random.choice(SERVER_ERRORS)
+            else:
+                status = 200
+        return latency, status
+
+    def answer(self, prompt):
+        digest = hashlib.md5(prompt.encode('utf-8')).digest()
+        return self.answers[int.from_bytes(digest[:4], 'big') % len(self.answers)]
+
+    def count(self, api, status):
+        with self.lock:
+            self.counts[f'{api} {status}'] += 1
+
+
+def apply_stop(text, stop):
+    # the completion ends before the first stop sequence, as in the real APIs
+    if isinstance(stop, str):
+        stop = [stop]
+    for sequence in stop or []:
+        text = text.split(sequence, 1)[0]
+    return text
+
+
+def openai_response(body, answer):
+    n = body.get('n', 1)
+    if 'messages' in body:
+        text = apply_stop(answer(body['messages'][-1]['content']), body.get('stop'))
+        choices = [{'index': i, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'} for i in range(n)]
+    else:
+        text = apply_stop(answer(body['prompt']), body.get('stop'))
+        choices = [{'index': i, 'text': text, 'logprobs': None, 'finish_reason': 'stop'} for i in range(n)]
+    return {
+        'id': 'mock', 'object': 'chat.completion' if 'messages' in body else 'text_completion', 'created': int(time.time()),
+        'model': body['model'], 'choices': choices, 'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+    }
+
+
+def claude_response(body, answer):
+    return {'completion': apply_stop(' ' + answer(body['prompt']), body.get('stop_sequences')), 'stop_reason': 'stop_sequence', 'truncated': False,
+            'model': body['model'], 'log_id': 'mock', 'exception': None}
+
+
+def hyperclova_response(body, answer):
+    # the completion follows the prompt, as in the real endpoint
+    return {'results': [{'text': text + answer(text)} for text in body['text_batch']]}
+
+
+def completion_length(api, body, data):
+    if api == 'openai':
+        return max(len(c['message']['content'] if 'message' in c else c['text']) for c in data['choices'])
+    if api == 'claude':
+        return len(data['completion'])
+    return max((len(r['text']) - len(t) for r, t in zip(data['results'], body['text_batch'])), default=0)
+
+
+def stream_events(api, body, data):
+    # the same completion, one character per event
+    if api == 'claude':
+        # api version 2023-01-01: every event has the whole completion so far
+        completion = data['completion']
+        for i in range(1, len(completion) + 1):
+            yield {**data, 'completion': completion[:i], 'stop_reason': data['stop_reason'] if i == len(completion) else None}
+        return
+
+    choice = data['choices'][0]
+    chat = 'message' in choice
+    text = choice['message']['content'] if chat else choice['text']
+    chunk = {'id': data['id'], 'object': 'chat.completion.chunk' if chat else 'text_completion',
+             'created': data['created'], 'model': data['model']}
+    for c in text:
+        delta = {'delta': {'content': c}} if chat else {'text': c, 'logprobs': None}
+        yield {**chunk, 'choices': [{'index': 0, **delta, 'finish_reason': None}]}
+    delta = {'delta': {}} if chat else {'text': '', 'logprobs': None}
+    yield {**chunk, 'choices': [{'index': 0, **delta, 'finish_reason': 'stop'}]}
+
+
+def error_response(api, status):
+    message = 'mock rate limit' if status == 429 else 'mock server error'
+    if api == 'openai':
+        return {'error': {'message': message, 'type': 'requests' if status == 429 else 'server_error', 'param': None, 'code': None}}
+    return {'error': {'type': 'rate_limit_error' if status == 429 else 'api_error', 'message': message}}
+
+
+# path suffix -> (api, response)
+ROUTES = {
+    '/chat/completions': ('openai', openai_response),
+    '/completions': ('openai', openai_response),
+    '/complete': ('claude', claude_response),
+    '/clova': ('hyperclova', hyperclova_response),
+}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        content = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_stream(self, api, events, token_latency):
+        # server-sent events until the completion ends or the client closes the connection
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for event in events:
+                time.sleep(token_latency)
+                self.wfile.write(f'data: {json.dumps(event, ensure_ascii=False)}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+            if api == 'openai':
+                self.wfile.write(b'data: [DONE]\n\n')
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            with self.server.behavior.lock:
+                self.send_json(200, dict(self.server.behavior.counts))
+        else:
+            self.send_json(404, {'error': {'message': f'{self.path} not found'}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        route = next((route for suffix, route in ROUTES.items() if self.path.rstrip('/').endswith(suffix)), None)
+        if route is None:
+            self.send_json(404, {'error': {'message': f'{self.path} not found'}})
+            return
+
+        api, make_response = route
+        behavior = self.server.behavior
+        latency, status = behavior.sample()
+        time.sleep(latency)
+        behavior.count(api, status)
+
+        if status == 429:
+            self.send_json(status, error_response(api, status), {'Retry-After': f'{behavior.retry_after:g}'})
+        elif status != 200:
+            self.send_json(status, error_response(api, status))
+        elif body.get('stream') and api in ['openai', 'claude']:
+            if not self.send_stream(api, stream_events(api, body, make_response(body, behavior.answer)), behavior.token_latency):
+                behavior.count(api, 'cancelled')
+        else:
+            data = make_response(body, behavior.answer)
+            time.sleep(behavior.token_latency * completion_length(api, body, data))
+            self.send_json(200, data)
+
+
+def make_server(host='127.0.0.1', port=8000, **kwargs):
+    # port 0 picks a free port; see server.server_address
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.behavior = MockBehavior(**kwargs)
+    return server
+
+
+def main(args):
+    server = make_server(
+        args.host, args.port,
+        latency=args.latency,
+        latency_dist=args.latency_dist,
+        latency_sigma=args.latency_sigma,
+        token_latency=args.token_latency,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        server_error_rate=args.server_error_rate,
+        answers=args.answers,
+        seed=args.seed
+    )
+    url = f'http://{args.host}:{server.server_address[1]}'
+    print(f'export OPENAI_URL={url}/v1')
+    print(f'export CLAUDE_URL={url}')
+    print(f'export CLOVA_URL={url}/clova', flush=True)
+
+    # the request counts are printed on Ctrl-C or kill
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(dict(server.behavior.counts), indent=4), flush=True)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,112 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import re
+import pandas as pd
+
+
+PREDICTION_PATTERN = re.compile(r'^\s*\(?(?P<raw>[^\.\n]*)\s*')
+CHOICE_PATTERN = re.compile(r'[:)]\s*(?P<choice>.*)\s*')
+FALLBACK_PATTERNS = [
+    re.compile(r'\*\*[\'\"]?(?P<answer>[^\.\n\*\'\"]*)\s*'),
+    re.compile(r'답변?[은:]\s*[\'\"]?(?P<answer>[^\.\n\*\'\"]*)\s*'),
+    re.compile(r'[\'\"](?P<answer>[^\.\n\*\'\"]*)\s*'),
+]
+ALPHABET_PATTERNS = {alphabet: re.compile(f'{alphabet}[:)]') for alphabet in ['A', 'B', 'C']}
+
+# "A", "(B)", "c:", "A) " ... up to the first period or line break
+FAST_PATTERN = re.compile(r'\s*\(?(?P<alphabet>[ABCabc])\s*[:)]?\s*(?:[\.\n]|$)')
+
+# short-answer mode: stop right after the letter, with a few tokens at most
+SHORT_ANSWER_STOP = ['\n', '.', ')', ':']
+SHORT_ANSWER_MAX_TOKENS = {'openai': 1, 'claude': 3, 'hyperclova': 3, 'koalpaca': 1}
+
+
+def prediction2choice(prediction, choices):
+    prediction = prediction.replace('없습니다', '없음').replace('입니다', '')
+
+    prediction_upper = prediction.upper()
+
+    if prediction_upper and (prediction_upper[0] in choices): # starts with A, B, C
+        match = CHOICE_PATTERN.search(prediction_upper)
+        choice = match.group('choice').strip() if match else ''
+
+        if choice:
+            if choices[prediction_upper[0]] == choice.lower():
+                return prediction_upper[0]
+            elif sum(prediction_upper.count(value.upper()) for value in choices.values()) > 1: # out-of-choice
+                return prediction
+            else:
+                return prediction_upper[0]
+
+        if sum(prediction_upper.count(alphabet) for alphabet in choices) == 1:
+            return prediction_upper[0]
+
+    prediction_lower = prediction.lower()
+    for alphabet, value in choices.items(): # one of choices
+        if prediction_lower == value:
+            return alphabet
+
+    return None
+
+
+def is_decided(raw, choices):
+    # True once more text cannot change raw2prediction(raw): the part before the first period or line break
+    # is complete and already maps to a choice (or to an out-of-choice answer)
+    match = PREDICTION_PATTERN.search(raw)
+    if match is None or match.end('raw') == len(raw):
+        return False
+    return prediction2choice(match.group('raw'), choices) is not None
+
+
+def get_stop_when(choices):
+    # choices: [A, B, C]; for streamed completions, which are cut where raw2prediction can no longer change
+    choices = dict(zip(['A', 'B', 'C'], [str(choice).lower() for choice in choices]))
+    return lambda text: is_decided(text, choices)
+
+
+def raw2prediction(raw, choices):
+    while True:
+        match = PREDICTION_PATTERN.search(raw) if isinstance(raw, str) else None
+        prediction = prediction2choice(match.group('raw') if match else '', choices)
+        if prediction is not None:
+            return prediction
+
+        # retry on the answer part of e.g. "**A**", "답: A", "'A'"
+        for pattern in FALLBACK_PATTERNS:
+            match = pattern.search(raw) if isinstance(raw, str) else None
+            if match:
+                raw = match.group('answer')
+                break
+        else:
+            break
+
+    raw_upper = raw.upper()
+    count = 0
+    answer_alphabet = ''
+    for alphabet in choices:
+        pattern = ALPHABET_PATTERNS.get(alphabet) or re.compile(f'{alphabet}[:)]')
+        if pattern.search(raw_upper):
+            answer_alphabet = alphabet
+            count += 1
+    if count == 1:
+        return answer_alphabet
+
+    return raw
+
+
+def raw2prediction_batch(raws, df_choices):
+    choices = df_choices[['A', 'B', 'C']].apply(lambda x: x.str.lower())
+
+    predictions = []
+    for raw, A, B, C in zip(raws, choices['A'], choices['B'], choices['C']):
+        match = FAST_PATTERN.match(raw) if isinstance(raw, str) else None
+        if match:
+            predictions.append(match.group('alphabet').upper())
+        else:
+            predictions.append(raw2prediction(raw, {'A': A, 'B': B, 'C': C}))
+
+    return pd.Series(predictions, index=df_choices.index, dtype=object)
@@ -0,0 +1,45 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import os
+import importlib
+
+
+GPT_MODEL = ['davinci', 'gpt-3.5-turbo', 'gpt-4']
+CLAUDE_MODEL = ['claude-instant-1.2', 'claude-2.0']
+HYPERCLOVA_MODEL = {'clova-x': os.environ.get('CLOVA_URL')}
+KOALPACA_MODEL = ['KoAlpaca-Polyglot-12.8B']
+
+SCORING_MODES = ['letter', 'choice']
+
+# backend -> (module, models); the module and its SDK (openai, anthropic, torch, ...) are imported on first use
+BACKENDS = {
+    'openai': ('model_inference.openai_utils', GPT_MODEL),
+    'claude': ('model_inference.claude_utils', CLAUDE_MODEL),
+    'hyperclova': ('model_inference.hyperclova_utils', HYPERCLOVA_MODEL),
+    'koalpaca': ('model_inference.koalpaca_utils', KOALPACA_MODEL),
+}
+
+
+def register_backend(name, module, models):
+    # module provides generate(prompts, model_name, max_tokens, **options) -> {guid: text}
+    BACKENDS[name] = (module, models)
+
+
+def get_backend(model_name):
+    for name, (_, models) in BACKENDS.items():
+        if model_name in models:
+            return name
+    raise ValueError(f'Unknown model {model_name}; models: {[model for _, models in BACKENDS.values() for model in models]}')
+
+
+def load_backend(model_name):
+    return importlib.import_module(BACKENDS[get_backend(model_name)][0])
+
+
+def generate(prompts, model_name, max_tokens, **options):
+    # prompts: {guid: prompt} -> {guid: text}
+    return load_backend(model_name).generate(prompts, model_name, max_tokens, **options)
@@ -0,0 +1,94 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+
+class ResponseCache:
+    def __init__(self, path, max_size=None):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT,
+                size INTEGER,
+                accessed REAL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.conn.commit()
+        self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(model_name, prompt, max_tokens, greedy):
+        key = json.dumps([model_name, prompt, max_tokens, greedy], ensure_ascii=False)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, model_name, prompt, max_tokens, greedy):
+        key = self.make_key(model_name, prompt, max_tokens, greedy)
+        with self.lock:
+            row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def set(self, model_name, prompt, max_tokens, greedy, response):
+        key = self.make_key(model_name, prompt, max_tokens, greedy)
+        size = len(key) + len(response.encode('utf-8'))
+        with self.lock:
+            old = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, size, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, model_name, response, size, time.time())
+            )
+            self.size += size - (old[0] if old else 0)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # least recently used entries go first
+        while self.max_size is not None and self.size > self.max_size:
+            rows = self.conn.execute('SELECT key, size FROM responses ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= size
+                self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.,
+            'evictions': self.evictions,
+            'size': self.size
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,130 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import io
+import os
+import csv
+import time
+from pathlib import Path
+
+
+class PredictionWriter:
+    def __init__(self, path, header, key='guid', fsync_interval=5.0):
+        self.path = Path(path)
+        self.header = header
+        self.key_index = header.index(key)
+        self.fsync_interval = fsync_interval
+        self.done = set()
+
+        if self.path.is_file() and self.path.stat().st_size > 0:
+            self._recover()
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8', newline='') as f:
+                csv.writer(f, delimiter='\t').writerow(header)
+
+        self.f = open(self.path, 'a', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.f, delimiter='\t')
+        self.last_sync = time.monotonic()
+
+    def _recover(self):
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            content = f.read()
+
+        consumed = 0
+
+        def lines():
+            nonlocal consumed
+            for line in io.StringIO(content, newline=''):
+                consumed += len(line)
+                yield line
+
+        # keep every complete record; a crash may leave a partial one at the end
+        valid_end = 0
+        reader = csv.reader(lines(), delimiter='\t', strict=True)
+        try:
+            for n, row in enumerate(reader):
+                if content[consumed - 1] not in '\r\n' or len(row) != len(self.header):
+                    break
+                if n == 0:
+                    if row != self.header:
+                        raise ValueError(f'Unexpected header in {self.path}: {row}')
+                else:
+                    self.done.add(row[self.key_index])
+                valid_end = consumed
+        except csv.Error:
+            pass
+
+        if valid_end == 0:
+            raise ValueError(f'Cannot recover {self.path}')
+
+        if valid_end < len(content):
+            print(f'Truncate incomplete record at the end of {self.path}')
+            with open(self.path, 'r+b') as f:
+                f.truncate(len(content[:valid_end].encode('utf-8')))
+
+    def write(self, rows):
+        for row in rows:
+            self.writer.writerow(row)
+            self.done.add(row[self.key_index])
+
+        if time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def merge_predictions(paths, output_path, guids, key='guid'):
+    # every guid must be in exactly one of the files; rows are written in the order of guids
+    header = None
+    records = {}
+    duplicated = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f, delimiter='\t', strict=True))
+        if header is None:
+            header = rows[0]
+        elif rows[0] != header:
+            raise ValueError(f'Unexpected header in {path}: {rows[0]}')
+
+        key_index = header.index(key)
+        for row in rows[1:]:
+            if len(row) != len(header):
+                raise ValueError(f'Incomplete record in {path}, rerun it to recover: {row}')
+            if row[key_index] in records:
+                duplicated.append(row[key_index])
+            records[row[key_index]] = row
+
+    if duplicated:
+        raise ValueError(f"{len(duplicated)} duplicated {key}: {', '.join(duplicated[:10])}")
+    missing = [guid for guid in guids if guid not in records]
+    if missing:
+        raise ValueError(f"{len(missing)} {key} Not Found: {', '.join(missing[:10])}")
+    unknown = records.keys() - set(guids)
+    if unknown:
+        raise ValueError(f"{len(unknown)} unknown {key}: {', '.join(sorted(unknown)[:10])}")
+
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(header)
+        writer.writerows(records[guid] for guid in guids)
+    os.replace(tmp_path, output_path)
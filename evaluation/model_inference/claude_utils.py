@@ -7,44 +7,85 @@ MIT license
 import os
 import json
 import time
+import threading
 import anthropic
 
+from model_inference.answer_utils import SHORT_ANSWER_MAX_TOKENS, SHORT_ANSWER_STOP, get_stop_when
+from model_inference.backend_utils import CLAUDE_MODEL
+from model_inference.rate_limit_utils import call_with_retry, estimate_tokens
+from model_inference.session_utils import get_session, get_timeout
+
 
-CLAUDE_MODEL = ['claude-instant-1.2', 'claude-2.0']
 CLAUDE_API_KEY = os.environ.get('CLAUDE')
+CLAUDE_URL = os.environ.get('CLAUDE_URL', 'https://api.anthropic.com')
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_claude_client():
+    # one client for all requests, on the shared keep-alive session
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = anthropic.Client(CLAUDE_API_KEY, api_url=CLAUDE_URL)
+            _client._session = get_session('claude')
+        _client.default_request_timeout = get_timeout('claude')
+        return _client
 
 
 def get_claude_response(
     prompt, 
     model_name, 
     max_tokens=128,
-    max_try=10
+    max_try=10,
+    stop_sequences=None,
+    stop_when=None
 ):
     assert model_name in CLAUDE_MODEL
     
-    n_try = 0
-    while True:
-        if n_try == max_try:
-            raise Exception('Something Wrong')
-        
+    request_params = {
+        'prompt': f'{anthropic.HUMAN_PROMPT} {prompt}{anthropic.AI_PROMPT}',
+        'stop_sequences': [anthropic.HUMAN_PROMPT] + (stop_sequences or []),
+        'model': model_name,
+        'max_tokens_to_sample': max_tokens
+    }
+
+    def request():
+        if stop_when is None:
+            return get_claude_client().completion(**request_params)['completion']
+
+        # each event has the whole completion so far; the stream is closed once stop_when(completion) is True
+        stream = get_claude_client().completion_stream(**request_params)
+        completion = ''
         try:
-            time.sleep(1)
-            c = anthropic.Client(CLAUDE_API_KEY)
-            resp = c.completion(
-                prompt=f'{anthropic.HUMAN_PROMPT} {prompt}{anthropic.AI_PROMPT}',
-                stop_sequences=[anthropic.HUMAN_PROMPT],
-                model=model_name,
-                max_tokens_to_sample=max_tokens
-            )
-            break
-            
-        except KeyboardInterrupt:
-            raise Exception('KeyboardInterrupt')
-        except Exception as e:
-            print(e)
-            print('Exception: Sleep for 5 sec')
-            time.sleep(5)
-            n_try += 1
-            continue
-            
-    return resp['completion']
+            for data in stream:
+                completion = data['completion']
+                if stop_when(completion):
+                    break
+        finally:
+            stream.close()
+        return completion
+
+    return call_with_retry(
+        request,
+        model_name,
+        n_tokens=estimate_tokens(prompt, max_tokens),
+        max_try=max_try
+    )
+
+
+def generate(prompts, model_name, max_tokens, short_answer=False, stream_choices=None, **options):
+    # one request per prompt
+    if short_answer:
+        max_tokens = SHORT_ANSWER_MAX_TOKENS['claude']
+    return {
+        key: get_claude_response(
+            prompt,
+            model_name,
+            max_tokens=max_tokens,
+            stop_sequences=SHORT_ANSWER_STOP if short_answer else None,
+            stop_when=get_stop_when(stream_choices[key]) if stream_choices else None
+        )
+        for key, prompt in prompts.items()
+    }
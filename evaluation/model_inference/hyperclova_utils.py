@@ -9,14 +9,28 @@ import time
 import json
 import requests
 
+from model_inference.answer_utils import SHORT_ANSWER_MAX_TOKENS, SHORT_ANSWER_STOP
+from model_inference.backend_utils import HYPERCLOVA_MODEL
+from model_inference.rate_limit_utils import call_with_retry, estimate_tokens
+from model_inference.session_utils import get_session, get_timeout
+
 
-HYPERCLOVA_MODEL = {'clova-x': os.environ.get('CLOVA_URL')}
 HEADERS = {
     'Content-Type': 'application/json; charset=utf-8',
     'Authorization': f'Bearer {os.environ.get("CLOVA")}'    
 }
 
 
+def cut_at_stop(text, stop):
+    # the endpoint has no stop sequences, so the completion is cut here, after any leading line breaks
+    if not stop:
+        return text
+    text = text.lstrip()
+    for sequence in stop:
+        text = text.split(sequence, 1)[0]
+    return text
+
+
 def get_hyperclova_response(
     text,
     model_name,
@@ -25,7 +39,8 @@ def get_hyperclova_response(
     top_p=None,
     max_tokens=128,
     repeat_penalty=3,
-    max_try=10
+    max_try=10,
+    stop=None
 ):
     assert model_name in HYPERCLOVA_MODEL
     
@@ -40,34 +55,37 @@ def get_hyperclova_response(
         data['temperature'] = temperature
         data['top_p']: top_p
 
-    n_try = 0
-    while True:
-        if n_try > max_try:
-            raise Exception('Something Wrong')
-
-        try:
-            response = requests.post(f'{HYPERCLOVA_MODEL[model_name]}',
-                                     headers=HEADERS,
-                                     data=json.dumps(data),
-                                     timeout=60)
-            
-            if response.status_code != 200:
-                print(f'Error from internal API: {response.status_code}')
-                time.sleep(5)
-                n_try += 1
-                continue
-            
-            outputs = response.json()['results']
-            results = [output['text'].strip().replace(prompt, '') for output, prompt in zip(outputs, data['text_batch'])]
-            break
+    def request():
+        response = get_session('hyperclova').post(f'{HYPERCLOVA_MODEL[model_name]}',
+                                                  headers=HEADERS,
+                                                  data=json.dumps(data),
+                                                  timeout=get_timeout('hyperclova'))
+        
+        if response.status_code != 200:
+            raise requests.HTTPError(f'status code: {response.status_code}', response=response)
+        
+        outputs = response.json()['results']
+        return [cut_at_stop(output['text'].strip().replace(prompt, ''), stop) for output, prompt in zip(outputs, data['text_batch'])]
 
-        except KeyboardInterrupt:
-            raise Exception('KeyboardInterrupt')
-        except Exception as e:
-            print(e)
-            print('Exception: Sleep for 5 sec')
-            time.sleep(5)
-            n_try += 1
-            continue
+    results = call_with_retry(
+        request,
+        model_name,
+        n_tokens=estimate_tokens(text, max_tokens),
+        max_try=max_try + 1
+    )
             
     return results
+
+
+def generate(prompts, model_name, max_tokens, short_answer=False, **options):
+    # all prompts in one request
+    if short_answer:
+        max_tokens = SHORT_ANSWER_MAX_TOKENS['hyperclova']
+    results = get_hyperclova_response(
+        list(prompts.values()),
+        model_name,
+        max_tokens=max_tokens,
+        greedy=True,
+        stop=SHORT_ANSWER_STOP if short_answer else None
+    )
+    return dict(zip(prompts, results))
@@ -6,36 +6,381 @@ MIT license
 
 import torch
 from tqdm.auto import tqdm
-from transformers import pipeline
+from transformers import LogitsProcessor, LogitsProcessorList, pipeline
+
+from model_inference.answer_utils import SHORT_ANSWER_MAX_TOKENS
+from model_inference.backend_utils import KOALPACA_MODEL
 
-KOALPACA_MODEL = ['KoAlpaca-Polyglot-12.8B']
 KOALPACA_MODEL_PATH = {'KoAlpaca-Polyglot-12.8B':'beomi/KoAlpaca-Polyglot-12.8B'}
 
-def load_koalpaca(model_name='KoAlpaca-Polyglot-12.8B'):
+CHOICE_LETTERS = ['A', 'B', 'C']
+
+def load_koalpaca(model_name='KoAlpaca-Polyglot-12.8B', model_path=None):
+    # model_path overrides the hub model, e.g. a local copy or a small model for testing on CPU
+    model_path = model_path or KOALPACA_MODEL_PATH[model_name]
     pipe = pipeline(
         'text-generation', 
-        torch_dtype=torch.bfloat16, 
-        model=KOALPACA_MODEL_PATH[model_name], 
-        tokenizer=KOALPACA_MODEL_PATH[model_name],
-        device_map="auto", 
+        torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
+        model=model_path, 
+        tokenizer=model_path,
+        device_map="auto" if torch.cuda.is_available() else None,
         trust_remote_code=True)
     pipe.model.config.pad_token_id = pipe.model.config.eos_token_id
+    pipe.tokenizer.pad_token_id = pipe.model.config.eos_token_id
     pipe.tokenizer.padding_side = 'left'
     return pipe
 
+
+def make_batches(lengths, max_batch_size, max_batch_tokens, order=None):
+    # sort by length so that prompts of similar length are padded together,
+    # then cut batches so that (batch size x longest prompt) stays under the token budget
+    order = order or sorted(lengths, key=lambda key: lengths[key])
+
+    batches = []
+    batch = []
+    longest = 0
+    for key in order:
+        if batch and ((len(batch) + 1) * max(longest, lengths[key]) > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+            longest = 0
+        batch.append(key)
+        longest = max(longest, lengths[key])
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class LetterLogitsProcessor(LogitsProcessor):
+    # short-answer mode: only the tokens of the choice letters can be generated
+    def __init__(self, token_ids):
+        self.token_ids = token_ids
+
+    def __call__(self, input_ids, scores):
+        mask = torch.full_like(scores, float('-inf'))
+        mask[:, self.token_ids] = 0
+        return scores + mask
+
+
+def get_letter_processor(tokenizer):
+    return LetterLogitsProcessor(sorted({i for ids in get_letter_ids(tokenizer).values() for i in ids}))
+
+
+@torch.no_grad()
+def _generate_batch(pipe, prompts, max_tokens, letters_only=False):
+    tokenizer, model = pipe.tokenizer, pipe.model
+    inputs = tokenizer(prompts, return_tensors='pt', padding=True, return_token_type_ids=False).to(model.device)
+    outputs = model.generate(
+        **inputs,
+        max_new_tokens=max_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
+        logits_processor=LogitsProcessorList([get_letter_processor(tokenizer)] if letters_only else [])
+    )
+    return tokenizer.batch_decode(outputs[:, inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+
+
+class PrefixCache:
+    # past key/values of prompt prefixes shared across prompts
+    # 'prefix': the instruction prefix common to all prompts, computed once
+    # 'context': also the longest prefix each prompt shares with another prompt of its batch,
+    #            e.g. the context of the bsd/cnt questions and their three permutations
+    def __init__(self, mode='prefix'):
+        self.mode = mode
+        self.ids = ()
+        self.past = None
+        self.prefilled = 0
+        self.reused = 0
+
+    def stats(self):
+        total = self.prefilled + self.reused
+        return {
+            'prefilled': self.prefilled,
+            'reused': self.reused,
+            'reuse_rate': self.reused / total if total else 0.0
+        }
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+@torch.no_grad()
+def run_prefix(model, ids, past=None):
+    # past key/values of a single token sequence, continuing from the past of its beginning
+    start = 0 if past is None else past[0][0].shape[2]
+    outputs = model(
+        input_ids=torch.tensor([ids[start:]], device=model.device),
+        position_ids=torch.arange(start, len(ids), device=model.device)[None],
+        past_key_values=past,
+        use_cache=True
+    )
+    return outputs.past_key_values
+
+
+def update_prefix(prefix_cache, model, input_ids, max_lengths):
+    # the instruction prefix is the longest prefix of all prompts; at least the last prompt token is left out
+    if prefix_cache.ids and len(prefix_cache.ids) <= min(max_lengths) \
+            and all(tuple(ids[:len(prefix_cache.ids)]) == prefix_cache.ids for ids in input_ids):
+        return
+    if len(input_ids) < 2:
+        return
+
+    n = min(max_lengths)
+    for ids in input_ids[1:]:
+        n = min(n, common_prefix_length(input_ids[0], ids))
+    prefix_cache.ids = tuple(input_ids[0][:n])
+    prefix_cache.past = run_prefix(model, prefix_cache.ids) if n > 0 else None
+    prefix_cache.prefilled += n
+
+
+def get_prefixes(prefix_cache, model, input_ids, max_lengths):
+    # (length, past) of the cached prefix of each prompt in a batch
+    if prefix_cache is None:
+        return [(0, None)] * len(input_ids)
+
+    n_prefix = len(prefix_cache.ids) if all(tuple(ids[:len(prefix_cache.ids)]) == prefix_cache.ids for ids in input_ids) else 0
+    lengths = [n_prefix] * len(input_ids)
+    if prefix_cache.mode == 'context':
+        order = sorted(range(len(input_ids)), key=lambda i: input_ids[i])
+        for i, j in zip(order, order[1:]):
+            n = common_prefix_length(input_ids[i], input_ids[j])
+            lengths[i] = max(lengths[i], min(n, max_lengths[i]))
+            lengths[j] = max(lengths[j], min(n, max_lengths[j]))
+
+    # shorter prefixes first, so that longer ones continue from them
+    pasts = {prefix_cache.ids[:n_prefix]: prefix_cache.past if n_prefix else None}
+    for key in sorted({tuple(ids[:n]) for ids, n in zip(input_ids, lengths)}, key=len):
+        if key in pasts:
+            continue
+        base = max((other for other in pasts if key[:len(other)] == other), key=len)
+        pasts[key] = run_prefix(model, key, pasts[base])
+        prefix_cache.prefilled += len(key) - len(base)
+
+    prefix_cache.reused += sum(lengths)
+    prefix_cache.prefilled += sum(len(ids) - n for ids, n in zip(input_ids, lengths))
+    return [(n, pasts[tuple(ids[:n])]) for ids, n in zip(input_ids, lengths)]
+
+
+@torch.no_grad()
+def prefill(model, input_ids, prefixes):
+    # row layout: [cached prefix | padding | padding | rest of the prompt]
+    # without cached prefixes this is plain left padding
+    device = model.device
+    pad_token_id = model.config.pad_token_id
+    n_past = max(n for n, _ in prefixes)
+    suffixes = [ids[n:] for ids, (n, _) in zip(input_ids, prefixes)]
+    length = max(len(suffix) for suffix in suffixes)
+
+    past = None
+    if n_past > 0:
+        reference = next(prefix_past for n, prefix_past in prefixes if n == n_past)
+        past = []
+        for layer, (reference_key, reference_value) in enumerate(reference):
+            keys, values = [], []
+            for n, prefix_past in prefixes:
+                shape = (1, reference_key.shape[1], n_past - n, reference_key.shape[3])
+                key, value = prefix_past[layer] if n > 0 else (reference_key[:, :, :0], reference_value[:, :, :0])
+                keys.append(torch.cat([key, reference_key.new_zeros(shape)], dim=2))
+                values.append(torch.cat([value, reference_value.new_zeros(shape)], dim=2))
+            past.append((torch.cat(keys), torch.cat(values)))
+        past = tuple(past)
+
+    inputs = torch.tensor([[pad_token_id] * (length - len(suffix)) + suffix for suffix in suffixes], device=device)
+    attention_mask = torch.tensor([
+        [1] * n + [0] * (n_past - n) + [0] * (length - len(suffix)) + [1] * len(suffix)
+        for (n, _), suffix in zip(prefixes, suffixes)
+    ], device=device)
+    position_ids = torch.tensor([
+        [0] * (length - len(suffix)) + list(range(n, n + len(suffix)))
+        for (n, _), suffix in zip(prefixes, suffixes)
+    ], device=device)
+
+    outputs = model(input_ids=inputs, attention_mask=attention_mask, position_ids=position_ids,
+                    past_key_values=past, use_cache=True)
+    next_positions = torch.tensor([len(ids) for ids in input_ids], device=device)
+    return outputs, attention_mask, next_positions
+
+
+@torch.no_grad()
+def generate_with_prefix(pipe, prompts, max_tokens, prefix_cache, letters_only=False):
+    # greedy decoding as in _generate_batch(), starting from the cached past of the shared prefixes
+    tokenizer, model = pipe.tokenizer, pipe.model
+    input_ids = tokenizer(prompts)['input_ids']
+    prefixes = get_prefixes(prefix_cache, model, input_ids, [len(ids) - 1 for ids in input_ids])
+    outputs, attention_mask, positions = prefill(model, input_ids, prefixes)
+    processor = get_letter_processor(tokenizer) if letters_only else None
+
+    eos_token_id = model.config.eos_token_id
+    finished = torch.zeros(len(prompts), dtype=torch.bool, device=model.device)
+    tokens = []
+    for step in range(max_tokens):
+        logits = outputs.logits[:, -1]
+        if processor is not None:
+            logits = processor(None, logits)
+        next_tokens = logits.argmax(dim=-1)
+        next_tokens = next_tokens.masked_fill(finished, tokenizer.pad_token_id)
+        tokens.append(next_tokens)
+        finished |= next_tokens == eos_token_id
+        if finished.all() or step == max_tokens - 1:
+            break
+
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(prompts), 1))], dim=-1)
+        outputs = model(input_ids=next_tokens[:, None], attention_mask=attention_mask, position_ids=positions[:, None],
+                        past_key_values=outputs.past_key_values, use_cache=True)
+        positions = positions + 1
+
+    return tokenizer.batch_decode(torch.stack(tokens, dim=-1), skip_special_tokens=True)
+
+
+def get_letter_ids(tokenizer):
+    # first token of each way the letter may be written after "정답:", e.g. "A", " A", "a", " a"
+    letter_ids = {}
+    for letter in CHOICE_LETTERS:
+        variants = [letter, ' ' + letter, letter.lower(), ' ' + letter.lower()]
+        letter_ids[letter] = sorted({tokenizer.encode(variant, add_special_tokens=False)[0] for variant in variants})
+    return letter_ids
+
+
+@torch.no_grad()
+def score_letters(pipe, prompts, prefix_cache=None):
+    # log-likelihood of answering A, B or C as the next token, one forward pass per prompt
+    tokenizer, model = pipe.tokenizer, pipe.model
+    input_ids = tokenizer(prompts)['input_ids']
+    prefixes = get_prefixes(prefix_cache, model, input_ids, [len(ids) - 1 for ids in input_ids])
+    log_probs = torch.log_softmax(prefill(model, input_ids, prefixes)[0].logits[:, -1].float(), dim=-1)
+
+    scores = torch.stack([
+        torch.logsumexp(log_probs[:, ids], dim=-1)
+        for ids in get_letter_ids(tokenizer).values()
+    ], dim=-1)
+    return [dict(zip(CHOICE_LETTERS, row)) for row in scores.tolist()]
+
+
+@torch.no_grad()
+def score_choices(pipe, prompts, choices, prefix_cache=None):
+    # log-likelihood of each choice string as the continuation of the prompt
+    tokenizer, model = pipe.tokenizer, pipe.model
+    prompt_ids = tokenizer(prompts)['input_ids']
+
+    input_ids = []
+    spans = []
+    max_lengths = []
+    for ids, row in zip(prompt_ids, choices):
+        for choice in row:
+            choice_ids = tokenizer.encode(' ' + choice, add_special_tokens=False)
+            input_ids.append(ids + choice_ids)
+            spans.append(len(choice_ids))
+            max_lengths.append(len(ids) - 1)
+    prefixes = get_prefixes(prefix_cache, model, input_ids, max_lengths)
+    log_probs = torch.log_softmax(prefill(model, input_ids, prefixes)[0].logits.float(), dim=-1)
+
+    scores = []
+    for i, n in enumerate(spans):
+        # logits at position t predict token t + 1
+        targets = torch.tensor(input_ids[i][-n:], device=log_probs.device)
+        scores.append(log_probs[i, -n - 1:-1].gather(-1, targets[:, None]).sum().item())
+    return [dict(zip(CHOICE_LETTERS, scores[i:i + len(CHOICE_LETTERS)])) for i in range(0, len(scores), len(CHOICE_LETTERS))]
+
+
+def run_batches(func, prompt, lengths, batch_size, max_batch_tokens, prefix_cache=None):
+    # func: list of keys -> list of outputs
+    order = None
+    if prefix_cache is not None and prefix_cache.mode == 'context':
+        # prompts sharing a context end up next to each other
+        order = sorted(prompt, key=lambda key: prompt[key])
+    batches = make_batches(lengths, batch_size, max_batch_tokens, order)
+
+    result = {}
+    progress = tqdm(total=len(prompt), disable=len(batches) == 1)
+    while batches:
+        batch = batches.pop(0)
+        try:
+            outputs = func(batch)
+        except torch.cuda.OutOfMemoryError:
+            if len(batch) == 1:
+                raise
+            # retry with halves instead of dropping the batch
+            torch.cuda.empty_cache()
+            batches[:0] = [batch[:len(batch) // 2], batch[len(batch) // 2:]]
+            continue
+
+        result.update(zip(batch, outputs))
+        progress.update(len(batch))
+    progress.close()
+
+    return result
+
+
 def get_koalpaca_response(
     prompt,
     model_name,
     pipe,
     max_tokens,
-    batch_size
+    batch_size,
+    max_batch_tokens=16384,
+    prefix_cache=None,
+    letters_only=False
+):
+    assert model_name in KOALPACA_MODEL
+
+    # prompt: {guid: prompt}
+    input_ids = pipe.tokenizer(list(prompt.values()))['input_ids']
+    lengths = {key: len(ids) for key, ids in zip(prompt, input_ids)}
+    if prefix_cache is None:
+        func = lambda batch: _generate_batch(pipe, [prompt[key] for key in batch], max_tokens, letters_only)
+    else:
+        update_prefix(prefix_cache, pipe.model, input_ids, [len(ids) - 1 for ids in input_ids])
+        func = lambda batch: generate_with_prefix(pipe, [prompt[key] for key in batch], max_tokens, prefix_cache, letters_only)
+
+    return run_batches(func, prompt, lengths, batch_size, max_batch_tokens, prefix_cache)
+
+
+def generate(prompts, model_name, max_tokens, pipe=None, batch_size=1, max_batch_tokens=16384, prefix_cache=None, short_answer=False, **options):
+    # batches of similar length, see get_koalpaca_response
+    if short_answer:
+        max_tokens = SHORT_ANSWER_MAX_TOKENS['koalpaca']
+    return get_koalpaca_response(
+        prompts,
+        model_name,
+        pipe,
+        max_tokens=max_tokens,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        prefix_cache=prefix_cache,
+        letters_only=short_answer
+    )
+
+
+def get_koalpaca_scores(
+    prompt,
+    choices,
+    model_name,
+    pipe,
+    scoring,
+    batch_size,
+    max_batch_tokens=16384,
+    prefix_cache=None
 ):
     assert model_name in KOALPACA_MODEL
-    result = []
-    try:
-        for idx, out in enumerate(tqdm(pipe(prompt, batch_size=batch_size, max_new_tokens=max_tokens), total=len(prompt))):
-            raw = out[0]['generated_text']
-            result.append(raw.split(prompt[idx])[-1])
-    except Exception as e:
-        print(e)
-    return result
\ No newline at end of file
+
+    # prompt: {guid: prompt}, choices: {guid: [A, B, C]} -> {guid: {'A': score, 'B': score, 'C': score}}
+    input_ids = pipe.tokenizer(list(prompt.values()))['input_ids']
+    lengths = {key: len(ids) for key, ids in zip(prompt, input_ids)}
+    if prefix_cache is not None:
+        update_prefix(prefix_cache, pipe.model, input_ids, [len(ids) - 1 for ids in input_ids])
+
+    if scoring == 'letter':
+        func = lambda batch: score_letters(pipe, [prompt[key] for key in batch], prefix_cache)
+    elif scoring == 'choice':
+        # each prompt is scored once per choice
+        lengths = {key: length * len(CHOICE_LETTERS) for key, length in lengths.items()}
+        func = lambda batch: score_choices(pipe, [prompt[key] for key in batch], [choices[key] for key in batch], prefix_cache)
+    else:
+        raise ValueError(scoring)
+
+    return run_batches(func, prompt, lengths, batch_size, max_batch_tokens, prefix_cache)
@@ -12,10 +12,27 @@ import json
 import openai
 import requests
 
+from model_inference.answer_utils import SHORT_ANSWER_MAX_TOKENS, SHORT_ANSWER_STOP, get_stop_when
+from model_inference.backend_utils import GPT_MODEL
+from model_inference.rate_limit_utils import call_with_retry, estimate_tokens
+from model_inference.session_utils import get_session, get_timeout
+from model_inference.telemetry_utils import add_usage
+
 
-GPT_MODEL = ['davinci', 'gpt-3.5-turbo', 'gpt-4']
 openai.organization = os.environ.get('OPENAI_ORG')
 openai.api_key = os.environ.get('OPENAI')
+# token ids of "A", "B", "C" and " A", " B", " C"
+LETTER_TOKEN_IDS = {
+    'davinci': [32, 33, 34, 317, 347, 327], # r50k_base
+    'gpt-3.5-turbo': [32, 33, 34, 362, 426, 356], # cl100k_base
+    'gpt-4': [32, 33, 34, 362, 426, 356], # cl100k_base
+}
+LETTER_BIAS = 100
+
+# e.g. the local mock_server.py
+openai.api_base = os.environ.get('OPENAI_URL', openai.api_base)
+# all threads share one pooled session instead of one session per thread
+openai.requestssession = get_session('openai')
 
 
 def check_gpt_input_list(history):
@@ -32,6 +49,37 @@ def check_gpt_input_list(history):
     return check
 
 
+def get_letter_bias(model_name):
+    # a bias of 100 leaves only the letters to choose from
+    return {str(token_id): LETTER_BIAS for token_id in LETTER_TOKEN_IDS[model_name]}
+
+
+def stream_gpt_response(prompt, stop_when):
+    # reads the completion as it is generated and closes the stream once stop_when(partial completion) is True
+    chat = 'messages' in prompt
+    create = openai.ChatCompletion.create if chat else openai.Completion.create
+    response = create(**prompt, stream=True, request_timeout=get_timeout('openai'))
+
+    text = ''
+    n_tokens = 0
+    try:
+        for chunk in response:
+            choice = chunk['choices'][0]
+            delta = choice['delta'].get('content', '') if chat else choice['text']
+            if not delta:
+                continue
+            text += delta
+            n_tokens += 1
+            if stop_when(text):
+                break
+    finally:
+        response.close()
+
+    # streamed responses have no usage; each chunk is one token
+    add_usage({'completion_tokens': n_tokens})
+    return text.strip('\n ')
+
+
 def get_gpt_response(
     text,
     model_name,
@@ -41,9 +89,13 @@ def get_gpt_response(
     greedy=False,
     num_sequence=1,
     max_try=60,
-    dialogue_history=None
+    dialogue_history=None,
+    stop=None,
+    logit_bias=None,
+    stop_when=None
 ):
     assert model_name in GPT_MODEL
+    assert stop_when is None or num_sequence == 1
 
     if model_name.startswith('gpt-3.5-turbo') or model_name.startswith('gpt-4'):
         if dialogue_history:
@@ -64,7 +116,7 @@ def get_gpt_response(
             'n': num_sequence
         }
 
-    else:    
+    else:
         prompt = {
             'model': model_name,
             'prompt': text,
@@ -74,31 +126,49 @@ def get_gpt_response(
             'n': num_sequence
         }
     
-    n_try = 0
-    while True:
-        if n_try == max_try:
-            raise Exception('Something Wrong')
-        
-        try:
-            if model_name.startswith('gpt-3.5-turbo') or model_name.startswith('gpt-4'):
-                time.sleep(1)
-                res = openai.ChatCompletion.create(**prompt)
-                outputs = [o['message']['content'].strip("\n ") for o in res['choices']]
-            else:
-                res = openai.Completion.create(**prompt)
-                outputs = [o['text'].strip('\n ') for o in res['choices']]
-            break
-            
-        except KeyboardInterrupt:
-            raise Exception('KeyboardInterrupt')
-        except Exception as e:
-            print(e)
-            print('Exception: Sleep for 5 sec')
-            time.sleep(5)
-            n_try += 1
-            continue
+    if stop:
+        prompt['stop'] = stop
+    if logit_bias:
+        prompt['logit_bias'] = logit_bias
+    
+    def request():
+        if stop_when is not None:
+            return [stream_gpt_response(prompt, stop_when)]
+        if model_name.startswith('gpt-3.5-turbo') or model_name.startswith('gpt-4'):
+            res = openai.ChatCompletion.create(**prompt, request_timeout=get_timeout('openai'))
+            add_usage(res.get('usage'))
+            return [o['message']['content'].strip("\n ") for o in res['choices']]
+        else:
+            res = openai.Completion.create(**prompt, request_timeout=get_timeout('openai'))
+            add_usage(res.get('usage'))
+            return [o['text'].strip('\n ') for o in res['choices']]
+
+    outputs = call_with_retry(
+        request,
+        model_name,
+        n_tokens=estimate_tokens(text, max_tokens * num_sequence),
+        max_try=max_try
+    )
         
     if len(outputs) == 1:
         outputs = outputs[0]
         
     return outputs
+
+
+def generate(prompts, model_name, max_tokens, short_answer=False, stream_choices=None, **options):
+    # one request per prompt
+    if short_answer:
+        max_tokens = SHORT_ANSWER_MAX_TOKENS['openai']
+    return {
+        key: get_gpt_response(
+            prompt,
+            model_name,
+            max_tokens=max_tokens,
+            greedy=True,
+            stop=SHORT_ANSWER_STOP if short_answer else None,
+            logit_bias=get_letter_bias(model_name) if short_answer else None,
+            stop_when=get_stop_when(stream_choices[key]) if stream_choices else None
+        )
+        for key, prompt in prompts.items()
+    }
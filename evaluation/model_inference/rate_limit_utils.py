@@ -0,0 +1,198 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import re
+import math
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+from model_inference.telemetry_utils import current_span
+
+
+# requests / tokens per minute by model, e.g. {'gpt-4': {'rpm': 200, 'tpm': 40000}}
+# no client-side budget by default, since quotas depend on the account; 429 responses still pause all workers
+MODEL_RATE_LIMITS = {}
+
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+RATE_LIMIT_BACKOFF_BASE = 5
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        # a 429 on one worker holds back every worker sharing the quota
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self, n_tokens=0):
+        while True:
+            with self.lock:
+                wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens and n_tokens:
+            self.tokens.acquire(n_tokens)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def set_rate_limit(model_name, rpm=None, tpm=None):
+    limits = dict(MODEL_RATE_LIMITS.get(model_name, {}))
+    if rpm is not None:
+        limits['rpm'] = rpm
+    if tpm is not None:
+        limits['tpm'] = tpm
+    MODEL_RATE_LIMITS[model_name] = limits
+    with _rate_limiters_lock:
+        _rate_limiters.pop(model_name, None)
+
+
+def get_rate_limiter(model_name):
+    with _rate_limiters_lock:
+        if model_name not in _rate_limiters:
+            limits = MODEL_RATE_LIMITS.get(model_name, {})
+            _rate_limiters[model_name] = RateLimiter(limits.get('rpm'), limits.get('tpm'))
+        return _rate_limiters[model_name]
+
+
+def describe_rate_limit(model_name):
+    limits = MODEL_RATE_LIMITS.get(model_name, {})
+    budgets = [f'{limits[key]} {key}' for key in ['rpm', 'tpm'] if limits.get(key)]
+    return f"{model_name}: {', '.join(budgets) if budgets else 'no rate limit'}"
+
+
+def count_tokens(text):
+    # rough BPE count without the tokenizer: about 4 ASCII characters per token,
+    # and about one token per other character, e.g. a Hangul syllable
+    n_ascii = len(text.encode('ascii', 'ignore'))
+    return math.ceil(n_ascii / 4) + len(text) - n_ascii
+
+
+def estimate_tokens(prompt, max_tokens):
+    if isinstance(prompt, (list, tuple)):
+        return sum(count_tokens(p) for p in prompt) + max_tokens * len(prompt)
+    return count_tokens(prompt) + max_tokens
+
+
+def get_status_code(e):
+    # openai.error.OpenAIError
+    status = getattr(e, 'http_status', None)
+    # requests.HTTPError
+    if status is None and getattr(e, 'response', None) is not None:
+        status = getattr(e.response, 'status_code', None)
+    # anthropic.ApiException only keeps the status code in its message
+    if status is None and e.args:
+        match = re.search(r'status code: (\d{3})', str(e.args[0]))
+        if match:
+            status = int(match.group(1))
+    return status
+
+
+def get_retry_after(e):
+    headers = getattr(e, 'headers', None)
+    if headers is None and getattr(e, 'response', None) is not None:
+        headers = getattr(e.response, 'headers', None)
+    if not headers:
+        return None
+
+    retry_after = headers.get('retry-after') or headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return max(0., float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(n_try, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** n_try))
+
+
+def call_with_retry(func, model_name, n_tokens=0, max_try=10):
+    limiter = get_rate_limiter(model_name)
+    span = current_span()
+    if span is not None:
+        span.add('estimated_tokens', n_tokens)
+
+    for n_try in range(max_try):
+        start = time.monotonic()
+        limiter.acquire(n_tokens)
+        if span is not None:
+            span.add('rate_limit_wait', time.monotonic() - start)
+            span.add('retries', n_try > 0)
+        try:
+            return func()
+
+        except KeyboardInterrupt:
+            raise Exception('KeyboardInterrupt')
+        except Exception as e:
+            status = get_status_code(e)
+            if span is not None:
+                span.error(e, status)
+
+            if status == 429:
+                delay = get_retry_after(e)
+                if delay is None:
+                    delay = RATE_LIMIT_BACKOFF_BASE + get_backoff(n_try, base=RATE_LIMIT_BACKOFF_BASE)
+                limiter.pause(delay)
+            elif status is not None and status >= 500:
+                delay = get_retry_after(e) or get_backoff(n_try)
+            elif status is not None and status >= 400:
+                # bad request, authentication, ... will not succeed on retry
+                raise
+            else:
+                # timeouts and connection errors
+                delay = get_backoff(n_try)
+
+            print(f'{type(e).__name__} ({status}): {e}')
+            print(f'Exception: Sleep for {delay:.1f} sec')
+            time.sleep(delay)
+
+    raise Exception('Something Wrong')
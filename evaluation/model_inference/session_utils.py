@@ -0,0 +1,61 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import threading
+import requests
+import requests.adapters
+
+
+# seconds to wait for a response, by backend
+REQUEST_TIMEOUTS = {
+    'openai': 600,
+    'claude': 600,
+    'hyperclova': 60,
+}
+
+# connections kept alive per host; should be at least the number of concurrent workers
+POOL_SIZE = 10
+MAX_CONNECTION_RETRIES = 2
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def set_timeout(backend, timeout):
+    REQUEST_TIMEOUTS[backend] = timeout
+
+
+def get_timeout(backend):
+    return REQUEST_TIMEOUTS.get(backend)
+
+
+def set_pool_size(pool_size):
+    global POOL_SIZE
+    POOL_SIZE = pool_size
+    with _sessions_lock:
+        for session in _sessions.values():
+            mount(session, pool_size)
+
+
+def mount(session, pool_size):
+    # connection errors before the request is sent are retried here; everything else by call_with_retry
+    for prefix in ['http://', 'https://']:
+        session.mount(prefix, requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=MAX_CONNECTION_RETRIES
+        ))
+
+
+def get_session(backend):
+    # one keep-alive session per backend, shared by all worker threads
+    with _sessions_lock:
+        if backend not in _sessions:
+            session = requests.Session()
+            mount(session, POOL_SIZE)
+            _sessions[backend] = session
+        return _sessions[backend]
+
@@ -0,0 +1,286 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import ast
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+# columnar file: MAGIC, header size (uint64), json header, then the column buffers
+COLUMNAR_SUFFIX = '.kbq'
+MAGIC = b'KOBBQCOL'
+ALIGNMENT = 8
+
+# label-like columns are always stored with a dictionary; other string columns when values repeat enough
+DICTIONARY_COLUMNS = ['label_annotation', 'bbq_category', 'answer_abc', 'topic', 'truth', 'prediction']
+DICTIONARY_RATIO = 0.5
+
+
+def is_columnar(path):
+    return Path(path).suffix == COLUMNAR_SUFFIX
+
+
+def parse_choices(df):
+    # tsv files keep the choices as a python list literal
+    if 'choices' in df.columns:
+        df['choices'] = df['choices'].map(ast.literal_eval)
+    return df
+
+
+def read_table(path, columns=None):
+    if is_columnar(path):
+        return ColumnarReader(path).read(columns)
+    return parse_choices(pd.read_csv(path, sep='\t', usecols=columns))
+
+
+def iter_table(path, chunk_size, columns=None):
+    if is_columnar(path):
+        reader = ColumnarReader(path)
+        for start in range(0, reader.n_rows, chunk_size):
+            yield reader.read(columns, start, start + chunk_size)
+        return
+
+    for df in pd.read_csv(path, sep='\t', usecols=columns, chunksize=chunk_size):
+        yield parse_choices(df).reset_index(drop=True)
+
+
+def read_metadata(path):
+    return ColumnarReader(path).metadata
+
+
+def write_table(df, path, metadata=None):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    if is_columnar(path):
+        with ColumnarWriter(path, metadata) as writer:
+            writer.write(df)
+    else:
+        df.to_csv(path, sep='\t', index=False)
+
+
+def is_null(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+class Spool:
+    # one buffer of a column, written to a temporary file chunk by chunk
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self.f = tempfile.TemporaryFile()
+        self.nbytes = 0
+
+    def write(self, values):
+        data = np.ascontiguousarray(values, dtype=self.dtype).tobytes()
+        self.f.write(data)
+        self.nbytes += len(data)
+
+
+class ColumnWriter:
+    def __init__(self, name, values):
+        self.name = name
+        self.kind = self.get_kind(name, values)
+        self.spools = {}
+        if self.kind == 'numeric':
+            self.dtype = np.asarray(values).dtype.str
+            self.spools['values'] = Spool(self.dtype)
+        elif self.kind == 'list':
+            self.child = ColumnWriter(name, pd.Series([item for row in values if not is_null(row) for item in row], dtype=object))
+            self.spools['offsets'] = Spool('<i8')
+            self.spools['offsets'].write([0])
+            self.end = 0
+        elif self.kind == 'dictionary':
+            self.categories = {}
+            self.spools['codes'] = Spool('<i4')
+        else:
+            # byte offsets locate a range of rows, character offsets split its decoded text
+            self.spools['offsets'] = Spool('<i8')
+            self.spools['offsets'].write([0])
+            self.spools['chars'] = Spool('<i8')
+            self.spools['chars'].write([0])
+            self.spools['data'] = Spool('u1')
+            self.spools['valid'] = Spool('u1')
+            self.end = 0
+            self.chars = 0
+
+    @staticmethod
+    def get_kind(name, values):
+        if values.dtype != object:
+            return 'numeric'
+        non_null = [value for value in values if not is_null(value)]
+        if non_null and all(isinstance(value, (list, tuple)) for value in non_null):
+            return 'list'
+        if name in DICTIONARY_COLUMNS or len(set(non_null)) <= DICTIONARY_RATIO * len(values):
+            return 'dictionary'
+        return 'string'
+
+    def promote(self, values):
+        # tsv chunks may infer different types, e.g. int64, then float64 for a chunk with missing values
+        spool = self.spools['values']
+        spool.f.seek(0)
+        written = np.frombuffer(spool.f.read(), dtype=spool.dtype)
+        spool.f.close()
+        if values.dtype == object:
+            if written.dtype.kind != 'f' or not np.isnan(written).all():
+                raise ValueError(f'Column {self.name} changed from {written.dtype} to strings')
+            self.__init__(self.name, values)
+            self.write(pd.Series([None] * len(written), dtype=object))
+        else:
+            self.dtype = np.result_type(written.dtype, values.dtype).str
+            self.spools['values'] = Spool(self.dtype)
+            self.spools['values'].write(written)
+
+    def write(self, values):
+        if self.kind == 'numeric' and values.dtype != self.dtype:
+            self.promote(values)
+
+        if self.kind == 'numeric':
+            self.spools['values'].write(values.to_numpy(dtype=self.dtype))
+        elif self.kind == 'list':
+            rows = [[] if is_null(row) else list(row) for row in values]
+            lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+            self.spools['offsets'].write(self.end + np.cumsum(lengths))
+            self.end += int(lengths.sum())
+            self.child.write(pd.Series([item for row in rows for item in row], dtype=object))
+        elif self.kind == 'dictionary':
+            codes = [-1 if is_null(value) else self.categories.setdefault(str(value), len(self.categories)) for value in values]
+            self.spools['codes'].write(codes)
+        else:
+            texts = ['' if is_null(value) else str(value) for value in values]
+            encoded = [text.encode('utf-8') for text in texts]
+            lengths = np.fromiter((len(value) for value in encoded), dtype=np.int64, count=len(encoded))
+            self.spools['offsets'].write(self.end + np.cumsum(lengths))
+            self.end += int(lengths.sum())
+            lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+            self.spools['chars'].write(self.chars + np.cumsum(lengths))
+            self.chars += int(lengths.sum())
+            self.spools['data'].write(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+            self.spools['valid'].write([not is_null(value) for value in values])
+
+    def spec(self):
+        spec = {'name': self.name, 'kind': self.kind}
+        if self.kind == 'numeric':
+            spec['dtype'] = self.dtype
+        elif self.kind == 'dictionary':
+            spec['categories'] = list(self.categories)
+        elif self.kind == 'list':
+            spec['child'] = self.child.spec()
+        return spec
+
+    def all_spools(self):
+        yield from self.spools.items()
+        if self.kind == 'list':
+            for name, spool in self.child.all_spools():
+                yield 'child.' + name, spool
+
+
+class ColumnarWriter:
+    # writes a data frame chunk by chunk; buffers are spooled to temporary files and joined on close
+    def __init__(self, path, metadata=None):
+        self.path = Path(path)
+        self.metadata = metadata or {}
+        self.columns = None
+        self.n_rows = 0
+
+    def write(self, df):
+        if self.columns is None:
+            self.columns = [ColumnWriter(name, df[name]) for name in df.columns]
+        elif [column.name for column in self.columns] != list(df.columns):
+            raise ValueError(f'Columns changed while writing {self.path}: {list(df.columns)}')
+
+        for column in self.columns:
+            column.write(df[column.name])
+        self.n_rows += len(df)
+
+    def close(self):
+        columns = self.columns or []
+        specs = []
+        offset = 0
+        for column in columns:
+            spec = column.spec()
+            spec['buffers'] = {}
+            for name, spool in column.all_spools():
+                spec['buffers'][name] = [offset, spool.nbytes, spool.dtype.str]
+                offset += spool.nbytes + (-spool.nbytes) % ALIGNMENT
+            specs.append(spec)
+
+        header = json.dumps({'n_rows': self.n_rows, 'metadata': self.metadata, 'columns': specs}, ensure_ascii=False).encode('utf-8')
+        header += b' ' * ((-len(MAGIC) - 8 - len(header)) % ALIGNMENT)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for column in columns:
+                for _, spool in column.all_spools():
+                    spool.f.seek(0)
+                    shutil.copyfileobj(spool.f, f)
+                    spool.f.close()
+                    f.write(b'\0' * ((-spool.nbytes) % ALIGNMENT))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ColumnarReader:
+    # columns are decoded from a memory map only when they are read
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{self.path} is not a columnar file')
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_size))
+        self.data_start = len(MAGIC) + 8 + header_size
+        self.n_rows = header['n_rows']
+        self.metadata = header['metadata']
+        self.columns = {spec['name']: spec for spec in header['columns']}
+        self.mm = np.memmap(self.path, dtype=np.uint8, mode='r')
+
+    def buffer(self, spec, name):
+        offset, nbytes, dtype = spec['buffers'][name]
+        start = self.data_start + offset
+        return self.mm[start:start + nbytes].view(np.dtype(dtype))
+
+    def decode(self, spec, start, stop):
+        if spec['kind'] == 'numeric':
+            return np.array(self.buffer(spec, 'values')[start:stop])
+
+        if spec['kind'] == 'dictionary':
+            codes = self.buffer(spec, 'codes')[start:stop]
+            categories = np.array(spec['categories'] + [np.nan], dtype=object)
+            return categories[codes]
+
+        if spec['kind'] == 'list':
+            offsets = self.buffer(spec, 'offsets')[start:stop + 1]
+            child = dict(spec['child'], buffers={key[len('child.'):]: value for key, value in spec['buffers'].items()
+                                                 if key.startswith('child.')})
+            items = self.decode(child, int(offsets[0]), int(offsets[-1]))
+            bounds = (offsets - offsets[0]).tolist()
+            values = np.empty(len(bounds) - 1, dtype=object)
+            values[:] = [items[i:j].tolist() for i, j in zip(bounds, bounds[1:])]
+            return values
+
+        offsets = self.buffer(spec, 'offsets')[start:stop + 1]
+        text = self.buffer(spec, 'data')[int(offsets[0]):int(offsets[-1])].tobytes().decode('utf-8')
+        chars = self.buffer(spec, 'chars')[start:stop + 1]
+        valid = self.buffer(spec, 'valid')[start:stop]
+        bounds = (chars - chars[0]).tolist()
+        values = np.empty(len(bounds) - 1, dtype=object)
+        values[:] = [text[i:j] if v else np.nan for i, j, v in zip(bounds, bounds[1:], valid)]
+        return values
+
+    def read(self, columns=None, start=0, stop=None):
+        columns = columns or list(self.columns)
+        stop = self.n_rows if stop is None else min(stop, self.n_rows)
+        return pd.DataFrame({name: self.decode(self.columns[name], start, stop) for name in columns},
+                            index=pd.RangeIndex(stop - start))
@@ -0,0 +1,187 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import os
+import json
+import time
+import threading
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from collections import Counter, defaultdict, deque
+
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+_local = threading.local()
+
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+class Span:
+    # one submitted request or batch; call_with_retry adds its retries and errors while it runs
+    def __init__(self, telemetry, **fields):
+        self.telemetry = telemetry
+        self.event = {
+            'retries': 0,
+            'errors': [],
+            'rate_limit_wait': 0.,
+            'estimated_tokens': 0,
+            'cache_hits': 0,
+            'prompt_tokens': None,
+            'completion_tokens': None,
+            **fields
+        }
+
+    def add(self, key, value):
+        self.event[key] = (self.event[key] or 0) + value
+
+    def error(self, e, status):
+        self.event['errors'].append({'class': type(e).__name__, 'status': status})
+
+    def __enter__(self):
+        self.parent = current_span()
+        _local.span = self
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.span = self.parent
+        self.event['latency'] = time.monotonic() - self.start
+        self.event['error_class'] = exc_type.__name__ if exc_type else (self.event['errors'][-1]['class'] if self.event['errors'] else None)
+        self.event['ok'] = exc_type is None
+        self.telemetry.record(self.event)
+
+
+def add_usage(usage):
+    # token counts reported by the API, e.g. the usage field of openai responses
+    span = current_span()
+    if span is not None and usage:
+        span.add('prompt_tokens', usage.get('prompt_tokens', 0))
+        span.add('completion_tokens', usage.get('completion_tokens', 0))
+
+
+def add_cache_hits(n):
+    # prompts answered from the response cache, without a request
+    span = current_span()
+    if span is not None:
+        span.add('cache_hits', n)
+
+
+class Telemetry:
+    # per-request events go to a jsonl trace; rolling per-(model, topic) summaries to a prometheus textfile
+    def __init__(self, trace_path=None, metrics_path=None, window=60., flush_interval=10.):
+        self.trace = None
+        if trace_path:
+            Path(trace_path).parent.mkdir(parents=True, exist_ok=True)
+            self.trace = open(trace_path, 'a', encoding='utf-8')
+        self.metrics_path = Path(metrics_path) if metrics_path else None
+        self.window = window
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_flush = self.started
+
+        self.recent = defaultdict(deque) # (model, topic) -> (time, latency, queue wait)
+        self.totals = defaultdict(Counter)
+        self.errors = defaultdict(Counter)
+
+    def span(self, **fields):
+        return Span(self, **fields)
+
+    def wrap(self, func, **fields):
+        # the queue wait runs from now until an executor thread starts func
+        submitted = time.monotonic()
+
+        def run(*args, **kwargs):
+            with self.span(queue_wait=time.monotonic() - submitted, **fields):
+                return func(*args, **kwargs)
+        return run
+
+    def record(self, event):
+        now = time.monotonic()
+        key = (event.get('model'), event.get('topic'))
+        with self.lock:
+            if self.trace:
+                self.trace.write(json.dumps({'time': datetime.now().isoformat(), **event}, ensure_ascii=False) + '\n')
+
+            totals = self.totals[key]
+            totals['cache_hits'] += event['cache_hits']
+            if event['cache_hits'] < event.get('batch_size', 1):
+                # a batch served entirely from the cache sent no request, so it stays out of the rates and latencies
+                self.recent[key].append((now, event['latency'], event.get('queue_wait', 0.)))
+                totals['requests'] += 1
+            totals['prompts'] += event.get('batch_size', 1) - event['cache_hits']
+            totals['retries'] += event['retries']
+            totals['failed'] += not event['ok']
+            for kind in ['prompt_tokens', 'completion_tokens', 'estimated_tokens']:
+                totals[kind] += event[kind] or 0
+            for error in event['errors']:
+                self.errors[key][error['class']] += 1
+
+            if now - self.last_flush >= self.flush_interval:
+                self._flush(now)
+
+    def _flush(self, now):
+        if self.trace:
+            self.trace.flush()
+        if self.metrics_path:
+            self.metrics_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.metrics_path.with_name(self.metrics_path.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self._format_metrics(now))
+            # node_exporter may read the file at any time
+            os.replace(tmp_path, self.metrics_path)
+        self.last_flush = now
+
+    def _format_metrics(self, now):
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append(f'# HELP kobbq_{name} {description}')
+            lines.append(f'# TYPE kobbq_{name} {kind}')
+            for labels, value in samples:
+                label = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'kobbq_{name}{{{label}}} {value:.6g}')
+
+        # the window is shorter at the start of a run
+        window = max(min(self.window, now - self.started), 1e-6)
+        rolling = {}
+        for key, recent in self.recent.items():
+            while recent and recent[0][0] < now - self.window:
+                recent.popleft()
+            rolling[key] = np.array([[latency, queue_wait] for _, latency, queue_wait in recent]).reshape(-1, 2)
+
+        def labels(key, **extra):
+            return {'model': key[0], 'topic': key[1], **extra}
+
+        metric('requests_total', 'counter', 'Requests (or batches) sent.', [(labels(k), t['requests']) for k, t in self.totals.items()])
+        metric('prompts_total', 'counter', 'Prompts sent.', [(labels(k), t['prompts']) for k, t in self.totals.items()])
+        metric('cache_hits_total', 'counter', 'Prompts answered from the response cache.',
+               [(labels(k), t['cache_hits']) for k, t in self.totals.items()])
+        metric('retries_total', 'counter', 'Retried attempts.', [(labels(k), t['retries']) for k, t in self.totals.items()])
+        metric('failed_requests_total', 'counter', 'Requests that failed after all retries.',
+               [(labels(k), t['failed']) for k, t in self.totals.items()])
+        metric('errors_total', 'counter', 'Errors by class, including retried ones.',
+               [(labels(k, error=error), n) for k, errors in self.errors.items() for error, n in errors.items()])
+        metric('tokens_total', 'counter', 'Tokens reported by the API, or estimated for rate limiting.',
+               [(labels(k, kind=kind), t[f'{kind}_tokens']) for k, t in self.totals.items() for kind in ['prompt', 'completion', 'estimated']])
+        metric('requests_per_second', 'gauge', f'Requests per second over the last {self.window:g} seconds.',
+               [(labels(k), len(values) / window) for k, values in rolling.items()])
+        metric('request_latency_seconds', 'gauge', f'Request latency quantiles over the last {self.window:g} seconds.',
+               [(labels(k, quantile=q), np.quantile(values[:, 0], q)) for k, values in rolling.items() if len(values) for q in QUANTILES])
+        metric('queue_wait_seconds', 'gauge', f'Queue wait quantiles over the last {self.window:g} seconds.',
+               [(labels(k, quantile=q), np.quantile(values[:, 1], q)) for k, values in rolling.items() if len(values) for q in QUANTILES])
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        with self.lock:
+            self._flush(time.monotonic())
+            if self.trace:
+                self.trace.close()
+                self.trace = None
@@ -0,0 +1,137 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import re
+import hashlib
+import itertools
+import pandas as pd
+
+
+SLOT_PATTERN = re.compile(r'\[(?P<key>[A-Z]\d+):\s*(?P<values>[^\]]*)\]')
+VARIABLE_PATTERN = re.compile(r'(?P<key>[A-Z]\d+):\s*\[(?P<values>[^\]]*)\]')
+CONTROL_PATTERN = re.compile(r'[\x00-\x08\x0e-\x1f\x7f]')
+
+UNKNOWN = '알 수 없음'
+BIASED_CONTEXT_VERSIONS = ['b', 'd'] # a, c: counter-biased context
+# b, d swap the two groups of a, c; sample numbers follow the order of a, c
+SWAPPED_VARIABLES = {'N1': 'N2', 'N2': 'N1', 'X1': 'X2', 'X2': 'X1'}
+
+SAMPLE_COLUMNS = ['sample_id', 'label_annotation', 'context', 'question', 'choices',
+                  'biased_answer', 'answer', 'bbq_id', 'bbq_category', 'prediction']
+
+
+def split_values(values):
+    return [value.strip() for value in values.split(',')]
+
+
+def parse_variables(text):
+    # 'N1: [손자, 손녀]; N2: [할아버지, 할머니]' -> {'N1': ['손자', '손녀'], 'N2': ['할아버지', '할머니']}
+    if not isinstance(text, str):
+        return {}
+    return {match['key']: split_values(match['values']) for match in VARIABLE_PATTERN.finditer(text)}
+
+
+def get_variables(row):
+    # the order of the variables decides the sample number
+    variables = parse_variables(row['Names'])
+    variables.update(parse_variables(row['Lexical_diversity']))
+    for column in ['Ambiguous_context', 'Disambiguating_context', 'Biased_question', 'Counter-biased_question',
+                   'Biased_question_answer', 'Counter-biased_question_answer']:
+        for match in SLOT_PATTERN.finditer(row[column]):
+            variables.setdefault(match['key'], split_values(match['values']))
+    return variables
+
+
+def fill(text, assignment):
+    # slots hold one value per variable value, with particles already attached, e.g. [N1: 손자와, 손녀와]
+    def replace(match):
+        values = split_values(match['values'])
+        return values[min(assignment[match['key']], len(values) - 1)]
+    return ' '.join(SLOT_PATTERN.sub(replace, text).split())
+
+
+def count_samples(row):
+    n = 1
+    for values in get_variables(row).values():
+        n *= len(values)
+    return n * 4
+
+
+def get_shard(key, num_shards):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % num_shards
+
+
+def is_sampled(key, sample_rate, seed):
+    if sample_rate is None or sample_rate >= 1:
+        return True
+    digest = hashlib.md5(f'{seed}:{key}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 < sample_rate
+
+
+def expand_template(row, num_shards=1, shard_index=0, sample_rate=None, seed=0):
+    # sample_id: {category}-{template id}{version}-{sample no}-{amb/dis}-{bsd/cnt}
+    variables = get_variables(row)
+    prefix = f"{row['Category'].lower()}-{int(row['ID']):03d}{row['version']}"
+    biased_context = row['version'] in BIASED_CONTEXT_VERSIONS
+
+    keys = list(variables)
+    if biased_context:
+        keys = [SWAPPED_VARIABLES[key] if SWAPPED_VARIABLES.get(key) in variables else key for key in keys]
+    for n, indices in enumerate(itertools.product(*(range(len(variables[key])) for key in keys)), start=1):
+        # the four questions of a combination stay together in a shard
+        combination_id = f'{prefix}-{n:03d}'
+        if num_shards > 1 and get_shard(combination_id, num_shards) != shard_index:
+            continue
+        if not is_sampled(combination_id, sample_rate, seed):
+            continue
+
+        assignment = dict(zip(keys, indices))
+        amb_context = fill(row['Ambiguous_context'], assignment)
+        dis_context = amb_context + ' ' + fill(row['Disambiguating_context'], assignment)
+        # answers become choices, so stray control characters such as '\x08' are dropped
+        biased_question_answer = CONTROL_PATTERN.sub('', fill(row['Biased_question_answer'], assignment))
+        counter_biased_question_answer = CONTROL_PATTERN.sub('', fill(row['Counter-biased_question_answer'], assignment))
+        choices = [biased_question_answer, counter_biased_question_answer, UNKNOWN]
+
+        questions = {
+            'bsd': (fill(row['Biased_question'], assignment), biased_question_answer,
+                    biased_question_answer if biased_context else counter_biased_question_answer),
+            'cnt': (fill(row['Counter-biased_question'], assignment), counter_biased_question_answer,
+                    counter_biased_question_answer if biased_context else biased_question_answer),
+        }
+        for amb_dis, context in [('amb', amb_context), ('dis', dis_context)]:
+            for question_type, (question, answer, biased_answer) in questions.items():
+                yield [
+                    f'{combination_id}-{amb_dis}-{question_type}',
+                    row['Label_annotation'],
+                    context,
+                    question,
+                    list(choices),
+                    biased_answer,
+                    answer if amb_dis == 'dis' else UNKNOWN,
+                    row['BBQ_id'],
+                    row['BBQ_category'],
+                    None
+                ]
+
+
+def iter_samples(templates_tsv_path, num_shards=1, shard_index=0, sample_rate=None, seed=0):
+    # every combination of every template: 76,568 samples, while KoBBQ_all_samples.tsv leaves out some of them (76,048)
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f'shard index {shard_index} out of range for {num_shards} shards')
+
+    df_templates = pd.read_csv(templates_tsv_path, sep='\t')
+    for _, row in df_templates.iterrows():
+        yield from expand_template(row, num_shards, shard_index, sample_rate, seed)
+
+
+def iter_sample_chunks(templates_tsv_path, chunk_size, num_shards=1, shard_index=0, sample_rate=None, seed=0):
+    samples = iter_samples(templates_tsv_path, num_shards, shard_index, sample_rate, seed)
+    while True:
+        chunk = list(itertools.islice(samples, chunk_size))
+        if not chunk:
+            break
+        yield pd.DataFrame(chunk, columns=SAMPLE_COLUMNS)
@@ -0,0 +1,82 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import sys
+import importlib
+import pandas as pd
+import pytest
+from pathlib import Path
+
+EVALUATION_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(EVALUATION_DIR))
+
+from model_inference.table_utils import read_table
+
+SAMPLES_TSV_PATH = EVALUATION_DIR.parent / 'data' / 'KoBBQ_test_samples.tsv'
+PROMPT_TSV_PATH = EVALUATION_DIR / '0_evaluation_prompts.tsv'
+N_SAMPLES = 8
+
+
+@pytest.fixture(scope='session')
+def samples():
+    # the three permutations of a few test samples with prompt 1, as written by 1_preprocess.py
+    preprocess = importlib.import_module('1_preprocess')
+    df_prompts = pd.read_csv(PROMPT_TSV_PATH, sep='\t')
+    df, prefix = preprocess.process(read_table(SAMPLES_TSV_PATH).head(N_SAMPLES), df_prompts, 1)
+    prompt = {row.sample_id: prefix + row.query for row in df.itertuples()}
+    choices = {row.sample_id: [row.A, row.B, row.C] for row in df.itertuples()}
+    return prompt, choices
+
+
+@pytest.fixture(scope='session')
+def tiny_model_path(tmp_path_factory, samples):
+    # a randomly initialized GPT-NeoX (the architecture of KoAlpaca-Polyglot) with a small BPE tokenizer, for CPU
+    torch = pytest.importorskip('torch')
+    tokenizers = pytest.importorskip('tokenizers')
+    transformers = pytest.importorskip('transformers')
+
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.BPE())
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = tokenizers.decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        list(samples[0].values()),
+        tokenizers.trainers.BpeTrainer(
+            vocab_size=500,
+            special_tokens=['<|endoftext|>'],
+            initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet()
+        )
+    )
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token='<|endoftext|>',
+        bos_token='<|endoftext|>',
+        unk_token='<|endoftext|>'
+    )
+
+    torch.manual_seed(0)
+    config = transformers.GPTNeoXConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=128,
+        max_position_embeddings=1024,
+        eos_token_id=0,
+        bos_token_id=0,
+        # larger random weights, so that the outputs depend on the prompt
+        initializer_range=0.5
+    )
+
+    path = tmp_path_factory.mktemp('tiny_model')
+    tokenizer.save_pretrained(path)
+    transformers.GPTNeoXForCausalLM(config).save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture(scope='session')
+def pipe(tiny_model_path):
+    from model_inference.koalpaca_utils import load_koalpaca
+    return load_koalpaca(model_path=tiny_model_path)
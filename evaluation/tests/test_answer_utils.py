@@ -0,0 +1,33 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import pandas as pd
+from pathlib import Path
+
+from model_inference.answer_utils import FAST_PATTERN, raw2prediction, raw2prediction_batch
+
+# raw outputs with their choices, and the prediction of the original raw2prediction of 3_postprocess_predictions.py
+CORPUS_PATH = Path(__file__).resolve().parent / 'data' / 'raw2prediction_corpus.jsonl'
+
+
+def load_corpus():
+    return pd.read_json(CORPUS_PATH, lines=True, dtype=False)
+
+
+def test_raw2prediction_matches_corpus():
+    df = load_corpus()
+    for row in df.itertuples():
+        choices = {'A': row.A.lower(), 'B': row.B.lower(), 'C': row.C.lower()}
+        assert raw2prediction(row.raw, choices) == row.prediction, row.raw
+
+
+def test_raw2prediction_batch_matches_corpus():
+    df = load_corpus()
+    # both the fast path and the full extractor are covered
+    assert 0 < sum(bool(FAST_PATTERN.match(raw)) for raw in df['raw']) < len(df)
+    predictions = raw2prediction_batch(df['raw'], df)
+    assert predictions.index.equals(df.index)
+    assert predictions.tolist() == df['prediction'].tolist()
@@ -0,0 +1,112 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from model_inference import backend_utils
+from model_inference.koalpaca_utils import PrefixCache, get_koalpaca_response, get_koalpaca_scores, make_batches, score_choices, score_letters
+
+MODEL_NAME = 'KoAlpaca-Polyglot-12.8B'
+MAX_TOKENS = 8
+# padding changes the float32 logits slightly
+SCORE_TOLERANCE = 1e-4
+
+
+def get_single_responses(prompt, pipe, **options):
+    # one prompt at a time, without padding
+    return {key: get_koalpaca_response({key: text}, MODEL_NAME, pipe, MAX_TOKENS, 1, **options)[key] for key, text in prompt.items()}
+
+
+def test_make_batches():
+    lengths = {'a': 5, 'b': 1, 'c': 3, 'd': 4, 'e': 2}
+    assert make_batches(lengths, 2, 100) == [['b', 'e'], ['c', 'd'], ['a']]
+    # 3 x 4 tokens is over the budget
+    assert make_batches(lengths, 10, 10) == [['b', 'e', 'c'], ['d', 'a']]
+    assert make_batches(lengths, 10, 1) == [['b'], ['e'], ['c'], ['d'], ['a']]
+
+
+@pytest.mark.parametrize('batch_size, max_batch_tokens', [(4, 16384), (24, 16384), (24, 1000)])
+def test_bucketed_batches_match_single_prompts(samples, pipe, batch_size, max_batch_tokens):
+    prompt, _ = samples
+    result = get_koalpaca_response(prompt, MODEL_NAME, pipe, MAX_TOKENS, batch_size, max_batch_tokens)
+    assert result == get_single_responses(prompt, pipe)
+
+
+def test_backend_generate(samples, pipe):
+    prompt, _ = samples
+    result = backend_utils.generate(prompt, MODEL_NAME, MAX_TOKENS, pipe=pipe, batch_size=8)
+    assert result == get_single_responses(prompt, pipe)
+
+    short = backend_utils.generate(prompt, MODEL_NAME, MAX_TOKENS, pipe=pipe, batch_size=8, short_answer=True)
+    assert set(short) == set(prompt)
+    assert all(text.strip().upper() in ['A', 'B', 'C'] for text in short.values())
+
+
+def assert_scores_close(result, expected):
+    assert set(result) == set(expected)
+    for key in expected:
+        assert result[key] == pytest.approx(expected[key], abs=SCORE_TOLERANCE)
+
+
+@pytest.mark.parametrize('scoring', ['letter', 'choice'])
+def test_batched_scores_match_single_prompts(samples, pipe, scoring):
+    prompt, choices = samples
+    result = get_koalpaca_scores(prompt, choices, MODEL_NAME, pipe, scoring, 8)
+    if scoring == 'letter':
+        expected = {key: score_letters(pipe, [text])[0] for key, text in prompt.items()}
+    else:
+        expected = {key: score_choices(pipe, [text], [choices[key]])[0] for key, text in prompt.items()}
+    assert_scores_close(result, expected)
+
+
+def test_choice_scores_are_log_likelihoods(samples, pipe):
+    prompt, choices = samples
+    key = next(iter(prompt))
+    tokenizer, model = pipe.tokenizer, pipe.model
+    prompt_ids = tokenizer.encode(prompt[key])
+
+    scores = score_choices(pipe, [prompt[key]], [choices[key]])[0]
+    for letter, choice in zip(['A', 'B', 'C'], choices[key]):
+        choice_ids = tokenizer.encode(' ' + choice, add_special_tokens=False)
+        with torch.no_grad():
+            log_probs = torch.log_softmax(model(torch.tensor([prompt_ids + choice_ids])).logits[0], dim=-1)
+        expected = sum(log_probs[len(prompt_ids) + i - 1, token].item() for i, token in enumerate(choice_ids))
+        assert scores[letter] == pytest.approx(expected, abs=SCORE_TOLERANCE)
+
+
+@pytest.mark.parametrize('mode', ['prefix', 'context'])
+@pytest.mark.parametrize('short_answer', [False, True])
+def test_kv_reuse_matches_plain_generation(samples, pipe, mode, short_answer):
+    prompt, _ = samples
+    expected = backend_utils.generate(prompt, MODEL_NAME, MAX_TOKENS, pipe=pipe, batch_size=8, short_answer=short_answer)
+    prefix_cache = PrefixCache(mode)
+    result = backend_utils.generate(prompt, MODEL_NAME, MAX_TOKENS, pipe=pipe, batch_size=8, prefix_cache=prefix_cache, short_answer=short_answer)
+    assert result == expected
+    assert prefix_cache.stats()['reused'] > 0
+
+
+@pytest.mark.parametrize('mode', ['prefix', 'context'])
+@pytest.mark.parametrize('scoring', ['letter', 'choice'])
+def test_kv_reuse_matches_plain_scores(samples, pipe, mode, scoring):
+    prompt, choices = samples
+    expected = get_koalpaca_scores(prompt, choices, MODEL_NAME, pipe, scoring, 8)
+    prefix_cache = PrefixCache(mode)
+    assert_scores_close(get_koalpaca_scores(prompt, choices, MODEL_NAME, pipe, scoring, 8, prefix_cache=prefix_cache), expected)
+    assert prefix_cache.stats()['reused'] > 0
+
+
+def test_context_reuse_covers_shared_contexts(samples, pipe):
+    # the permutations of a sample share its context, so more of each prompt is reused than the instruction prefix
+    prompt, _ = samples
+    stats = {}
+    for mode in ['prefix', 'context']:
+        prefix_cache = PrefixCache(mode)
+        get_koalpaca_response(prompt, MODEL_NAME, pipe, MAX_TOKENS, 8, prefix_cache=prefix_cache)
+        stats[mode] = prefix_cache.stats()
+    assert stats['context']['reuse_rate'] > stats['prefix']['reuse_rate']
@@ -0,0 +1,113 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import sys
+import pandas as pd
+import pytest
+from pathlib import Path
+
+import kobbq
+import fake_backend
+from model_inference.backend_utils import BACKENDS, register_backend
+
+EVALUATION_DIR = Path(__file__).resolve().parents[1]
+SAMPLES_TSV_PATH = EVALUATION_DIR.parent / 'data' / 'KoBBQ_test_samples.tsv'
+PROMPT_TSV_PATH = EVALUATION_DIR / '0_evaluation_prompts.tsv'
+N_SAMPLES = 20
+
+
+@pytest.fixture(autouse=True)
+def fake_model():
+    register_backend('fake', 'fake_backend', [fake_backend.FAKE_MODEL])
+    fake_backend.requests.clear()
+    yield
+    BACKENDS.pop('fake')
+
+
+def run_kobbq(monkeypatch, samples_tsv_path, output_dir, *options):
+    monkeypatch.setattr(sys, 'argv', [
+        'kobbq.py',
+        '--samples-tsv-path', str(samples_tsv_path),
+        '--prompt-tsv-path', str(PROMPT_TSV_PATH),
+        '--prompt-id', '1', '2',
+        '--models', fake_backend.FAKE_MODEL,
+        '--test-or-all', 'test',
+        '--evaluation-result-path', str(output_dir / 'result.tsv'),
+        '--predictions-tsv-path', str(output_dir / 'predictions_{prompt_id}.tsv'),
+        '--model-result-tsv-path', str(output_dir / 'model_result_{prompt_id}.tsv'),
+        '--chunk-size', '8',
+        *options
+    ])
+    kobbq.main(kobbq.parse_args())
+    return pd.read_csv(output_dir / 'result.tsv', sep='\t')
+
+
+@pytest.fixture
+def samples_tsv_path(tmp_path):
+    path = tmp_path / 'samples.tsv'
+    pd.read_csv(SAMPLES_TSV_PATH, sep='\t').head(N_SAMPLES).to_csv(path, sep='\t', index=False)
+    return path
+
+
+def test_matches_evaluation_script(monkeypatch, tmp_path, samples_tsv_path):
+    result = run_kobbq(monkeypatch, samples_tsv_path, tmp_path, '--num-workers', '4')
+    # three permutations of every sample, for each prompt
+    assert len(fake_backend.requests) == N_SAMPLES * 3 * 2
+
+    df_prompts = pd.read_csv(PROMPT_TSV_PATH, sep='\t')
+    for prompt_id in [1, 2]:
+        unk_ans = df_prompts[df_prompts['prompt_id'] == prompt_id]['unknown'].item()
+        expected = pd.DataFrame(
+            kobbq.evaluation.evaluate_model(fake_backend.FAKE_MODEL, tmp_path / f'model_result_{prompt_id}.tsv', 'test', unk_ans),
+            columns=['model', 'category'] + kobbq.evaluation.METRICS
+        )
+        actual = result[result['prompt id'] == prompt_id].drop(columns='prompt id').reset_index(drop=True)
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+
+def test_resume_skips_done_rows(monkeypatch, tmp_path, samples_tsv_path):
+    first = run_kobbq(monkeypatch, samples_tsv_path, tmp_path / 'first')
+
+    # keep the header and half of the rows of each predictions file
+    resumed_dir = tmp_path / 'resumed'
+    resumed_dir.mkdir()
+    n_kept = 0
+    for prompt_id in [1, 2]:
+        lines = (tmp_path / 'first' / f'predictions_{prompt_id}.tsv').read_text(encoding='utf-8').splitlines(keepends=True)
+        kept = lines[:1 + (len(lines) - 1) // 2]
+        (resumed_dir / f'predictions_{prompt_id}.tsv').write_text(''.join(kept), encoding='utf-8')
+        n_kept += len(kept) - 1
+
+    fake_backend.requests.clear()
+    resumed = run_kobbq(monkeypatch, samples_tsv_path, resumed_dir)
+    assert len(fake_backend.requests) == N_SAMPLES * 3 * 2 - n_kept
+    pd.testing.assert_frame_equal(resumed, first)
+    for prompt_id in [1, 2]:
+        predictions = pd.read_csv(resumed_dir / f'predictions_{prompt_id}.tsv', sep='\t')
+        assert predictions['guid'].is_unique and len(predictions) == N_SAMPLES * 3
+
+    # nothing is left to run
+    fake_backend.requests.clear()
+    pd.testing.assert_frame_equal(run_kobbq(monkeypatch, samples_tsv_path, resumed_dir), first)
+    assert fake_backend.requests == []
+
+
+def test_empty_input(monkeypatch, tmp_path):
+    path = tmp_path / 'samples.tsv'
+    pd.read_csv(SAMPLES_TSV_PATH, sep='\t').head(0).to_csv(path, sep='\t', index=False)
+    result = run_kobbq(monkeypatch, path, tmp_path)
+    assert result.empty
+    assert result.columns.tolist() == ['model', 'prompt id', 'category'] + kobbq.evaluation.METRICS
+
+
+def test_rejects_workers_for_local_models(monkeypatch, tmp_path, samples_tsv_path):
+    monkeypatch.setattr(sys, 'argv', [
+        'kobbq.py', '--samples-tsv-path', str(samples_tsv_path), '--prompt-tsv-path', str(PROMPT_TSV_PATH),
+        '--prompt-id', '1', '--models', 'KoAlpaca-Polyglot-12.8B', '--test-or-all', 'test',
+        '--evaluation-result-path', str(tmp_path / 'result.tsv'), '--num-workers', '2'
+    ])
+    with pytest.raises(NotImplementedError):
+        kobbq.main(kobbq.parse_args())
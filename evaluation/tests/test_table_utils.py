@@ -0,0 +1,135 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+from pathlib import Path
+
+from model_inference.table_utils import ColumnarReader, ColumnarWriter, iter_table, read_metadata, read_table, write_table
+
+SAMPLES_TSV_PATH = Path(__file__).resolve().parents[2] / 'data' / 'KoBBQ_test_samples.tsv'
+
+
+def make_frame():
+    return pd.DataFrame({
+        'int': np.arange(6, dtype=np.int64),
+        'float': [0.5, np.nan, -1., 2.25, 0., 1e10],
+        'bool': [True, False, True, True, False, False],
+        'label_annotation': ['ST', 'TM', 'ST', None, 'NC', 'ST'],
+        'repeated': ['a', 'b', 'a', 'b', 'a', 'b'],
+        'text': ['맥락: 할머니', '', None, 'tab\tand\nnewline', 'émoji 😀', 'plain'],
+        'choices': [['손자', '할머니', '알 수 없음'], [], None, ['', 'x'], ['하나'], ['a', 'b', 'c']],
+    })
+
+
+def expected_frame():
+    # nulls are read back as NaN, and a null list as an empty list
+    df = make_frame()
+    df['label_annotation'] = df['label_annotation'].fillna(np.nan)
+    df['text'] = df['text'].fillna(np.nan)
+    df['choices'] = [row if row is not None else [] for row in df['choices']]
+    return df
+
+
+def write(path, chunks, metadata=None):
+    with ColumnarWriter(path, metadata) as writer:
+        for chunk in chunks:
+            writer.write(chunk.reset_index(drop=True))
+
+
+def test_column_kinds(tmp_path):
+    path = tmp_path / 'table.kbq'
+    write(path, [make_frame()])
+    kinds = {name: spec['kind'] for name, spec in ColumnarReader(path).columns.items()}
+    assert kinds == {
+        'int': 'numeric', 'float': 'numeric', 'bool': 'numeric',
+        'label_annotation': 'dictionary', 'repeated': 'dictionary',
+        'text': 'string', 'choices': 'list',
+    }
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'table.kbq'
+    write(path, [make_frame()])
+    pd.testing.assert_frame_equal(read_table(path), expected_frame())
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 4])
+def test_multi_chunk_write(tmp_path, chunk_size):
+    df = make_frame()
+    path = tmp_path / 'table.kbq'
+    write(path, [df[i:i + chunk_size] for i in range(0, len(df), chunk_size)])
+    pd.testing.assert_frame_equal(read_table(path), expected_frame())
+
+
+def test_chunks_with_changing_types(tmp_path):
+    # as read from a tsv in chunks: int64, then float64 with missing values; all missing, then strings
+    path = tmp_path / 'table.kbq'
+    write(path, [
+        pd.DataFrame({'number': [1, 2], 'text': [np.nan, np.nan]}),
+        pd.DataFrame({'number': [np.nan, 4.5], 'text': ['x', 'y']}),
+    ])
+    df = read_table(path)
+    assert df['number'].tolist()[:2] == [1., 2.] and np.isnan(df['number'][2]) and df['number'][3] == 4.5
+    assert df['text'].isna().tolist() == [True, True, False, False]
+    assert df['text'].tolist()[2:] == ['x', 'y']
+
+    with pytest.raises(ValueError):
+        write(tmp_path / 'bad.kbq', [pd.DataFrame({'number': [1, 2]}), pd.DataFrame({'number': ['x', 'y']})])
+
+
+def test_columns_and_row_ranges(tmp_path):
+    path = tmp_path / 'table.kbq'
+    write(path, [make_frame()])
+    expected = expected_frame()
+    reader = ColumnarReader(path)
+    assert reader.n_rows == len(expected)
+
+    columns = ['choices', 'text', 'int']
+    pd.testing.assert_frame_equal(read_table(path, columns=columns), expected[columns])
+    for start, stop in [(0, 1), (1, 4), (3, 6), (5, 100), (6, 6)]:
+        pd.testing.assert_frame_equal(
+            reader.read(columns, start, stop),
+            expected[columns][start:stop].reset_index(drop=True)
+        )
+
+    chunks = list(iter_table(path, 4, columns=['text', 'choices']))
+    assert [len(chunk) for chunk in chunks] == [4, 2]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected[['text', 'choices']])
+
+
+def test_metadata(tmp_path):
+    path = tmp_path / 'table.kbq'
+    metadata = {'ver': 'test', 'prefix': '주어진 맥락을 천천히 읽고\n\n'}
+    write(path, [make_frame()], metadata)
+    assert read_metadata(path) == metadata
+
+    write(tmp_path / 'plain.kbq', [make_frame()])
+    assert read_metadata(tmp_path / 'plain.kbq') == {}
+
+
+def test_empty_table(tmp_path):
+    path = tmp_path / 'empty.kbq'
+    write(path, [])
+    assert ColumnarReader(path).n_rows == 0
+    assert read_table(path).empty
+
+
+def test_not_columnar(tmp_path):
+    path = tmp_path / 'table.kbq'
+    path.write_bytes(b'sample_id\tcontext\n')
+    with pytest.raises(ValueError):
+        read_table(path)
+
+
+def test_samples_match_tsv(tmp_path):
+    # the released samples, through write_table and read_table in both formats
+    df = read_table(SAMPLES_TSV_PATH)
+    write_table(df, tmp_path / 'samples.kbq', {'source': SAMPLES_TSV_PATH.name})
+    write_table(df, tmp_path / 'samples.tsv')
+    pd.testing.assert_frame_equal(read_table(tmp_path / 'samples.kbq'), df)
+    pd.testing.assert_frame_equal(read_table(tmp_path / 'samples.tsv'), df)
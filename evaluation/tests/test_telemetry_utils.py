@@ -0,0 +1,37 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import time
+
+from model_inference.telemetry_utils import Telemetry, add_cache_hits
+
+
+def run(telemetry, batch_size, cache_hits, latency=0.):
+    def request():
+        add_cache_hits(cache_hits)
+        time.sleep(latency)
+    telemetry.wrap(request, model='model', topic='topic', batch_size=batch_size)()
+
+
+def test_cache_hits_stay_out_of_latencies(tmp_path):
+    metrics_path = tmp_path / 'metrics.prom'
+    telemetry = Telemetry(metrics_path=metrics_path, flush_interval=float('inf'))
+    run(telemetry, 4, 0, latency=0.05)
+    run(telemetry, 4, 1, latency=0.05)
+    for _ in range(10):
+        run(telemetry, 4, 4)
+    telemetry.close()
+
+    totals = telemetry.totals[('model', 'topic')]
+    assert totals['requests'] == 2
+    assert totals['prompts'] == 7
+    assert totals['cache_hits'] == 41
+    assert len(telemetry.recent[('model', 'topic')]) == 2
+
+    metrics = metrics_path.read_text(encoding='utf-8')
+    assert 'kobbq_cache_hits_total{model="model",topic="topic"} 41' in metrics
+    latency = [line for line in metrics.splitlines() if line.startswith('kobbq_request_latency_seconds{') and 'quantile="0.5"' in line]
+    assert float(latency[0].split()[-1]) >= 0.05
@@ -0,0 +1,39 @@
+'''
+KoBBQ
+Copyright (c) 2024-present NAVER Cloud Corp.
+MIT license
+'''
+
+import pandas as pd
+from pathlib import Path
+
+from model_inference.table_utils import read_table
+from model_inference.template_utils import SAMPLE_COLUMNS, count_samples, expand_template, iter_sample_chunks
+
+DATA_DIR = Path(__file__).resolve().parents[2] / 'data'
+TEMPLATES_TSV_PATH = DATA_DIR / 'KoBBQ_templates.tsv'
+SAMPLES_TSV_PATH = DATA_DIR / 'KoBBQ_test_samples.tsv'
+
+
+def test_expansion_reproduces_test_samples():
+    df_templates = pd.read_csv(TEMPLATES_TSV_PATH, sep='\t')
+    df_test = read_table(SAMPLES_TSV_PATH)
+
+    expanded = pd.DataFrame(
+        [sample for _, row in df_templates.iterrows() for sample in expand_template(row)],
+        columns=SAMPLE_COLUMNS
+    ).set_index('sample_id')
+
+    columns = ['label_annotation', 'context', 'question', 'choices', 'biased_answer', 'answer', 'bbq_id', 'bbq_category']
+    pd.testing.assert_frame_equal(
+        df_test.set_index('sample_id')[columns],
+        expanded.loc[df_test['sample_id'], columns],
+        check_dtype=False
+    )
+
+
+def test_expansion_is_a_superset_of_all_samples():
+    # KoBBQ_all_samples.tsv has 76,048 samples; the expansion keeps every combination
+    df_templates = pd.read_csv(TEMPLATES_TSV_PATH, sep='\t')
+    assert sum(count_samples(row) for _, row in df_templates.iterrows()) == 76568
+    assert sum(len(df) for df in iter_sample_chunks(TEMPLATES_TSV_PATH, 10000)) == 76568